@@ -0,0 +1,360 @@
+"""asyncirc -- Coroutine support for irclib.
+
+This module contains AsyncIRC, AsyncServerConnection and
+AsyncDCCConnection.  They run on the irclib event loop and generate
+exactly the same events as IRC, ServerConnection and DCCConnection
+(pubmsg, privmsg, ctcp, namreply, dccmsg, ...), but:
+
+  * Event handlers may be coroutines.  A handler that returns a
+    generator is run as a Task: each time the generator yields,
+    control goes back to the event loop, so a handler that waits for
+    something doesn't stall the other connections.
+  * drain() returns a Future that a coroutine can yield to wait
+    until irclib's output buffer has been written out.
+  * connect() takes a timeout and returns a Future that is resolved
+    when the server has welcomed the client.
+
+A coroutine yields a Future (or Task) to wait for it, a number to
+sleep that many seconds, or None to just let others run.  The value
+of the yield expression is the result of the Future; if the Future
+failed, its exception is raised at the yield.  Python 2 generators
+can't return values, so a coroutine that wants to produce a result
+raises StopIteration(result).
+
+Example:
+
+    def on_pubmsg(c, e):
+        c.privmsg(e.target(), "Thinking...")
+        yield 3
+        c.privmsg(e.target(), "Done.")
+        yield c.drain()
+
+Existing SimpleIRCClient subclasses, like the SingleServerIRCBot
+based bots, can run on AsyncIRC by mixing in AsyncBotMixin:
+
+    class AsyncWolfBot(AsyncBotMixin, WolfBot):
+        pass
+"""
+
+import sys
+import traceback
+import types
+
+import irclib
+from irclib import IRC, ServerConnection, DCCConnection, Event
+from irclib import ServerConnectionError
+
+
+class Future:
+    """The result of an operation that hasn't necessarily finished."""
+
+    def __init__(self):
+        self._done = 0
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """Return true if the result (or an exception) has been set."""
+        return self._done
+
+    def result(self):
+        """Return the result, or raise the exception, of the operation."""
+        if not self._done:
+            raise irclib.IRCError, "Result isn't available yet."
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, fn):
+        """Call fn with the Future as argument when it is done."""
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        """Mark the Future as done, with the given result."""
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        """Mark the Future as failed, with the given exception."""
+        self._set_exc_info((exception.__class__, exception, None))
+
+    def _set_exc_info(self, exc_info):
+        """[Internal]"""
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        """[Internal]"""
+        if self._done:
+            raise irclib.IRCError, "Future is already done."
+        self._done = 1
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class Task(Future):
+    """A coroutine scheduled on an IRC event loop.
+
+    The Task is done when the coroutine finishes.
+    """
+
+    def __init__(self, ircobj, coroutine):
+        Future.__init__(self)
+        self._ircobj = ircobj
+        self._coroutine = coroutine
+        self._step(None, None)
+
+    def _step(self, value, exc_info):
+        """[Internal] Run the coroutine until its next yield."""
+        try:
+            if exc_info:
+                yielded = self._coroutine.throw(*exc_info)
+            else:
+                yielded = self._coroutine.send(value)
+        except StopIteration, x:
+            if x.args:
+                self.set_result(x.args[0])
+            else:
+                self.set_result(None)
+            return
+        except:
+            self._set_exc_info(sys.exc_info())
+            return
+
+        if isinstance(yielded, Future):
+            yielded.add_done_callback(self._wakeup)
+        elif yielded is None:
+            self._ircobj.execute_delayed(0, self._step, (None, None))
+        elif type(yielded) in (types.IntType, types.LongType,
+                               types.FloatType):
+            self._ircobj.execute_delayed(yielded, self._step, (None, None))
+        else:
+            try:
+                raise TypeError, "Coroutine yielded %r" % (yielded,)
+            except TypeError:
+                self._ircobj.execute_delayed(0, self._step,
+                                             (None, sys.exc_info()))
+
+    def _wakeup(self, future):
+        """[Internal]"""
+        try:
+            value = future.result()
+        except:
+            self._step(None, sys.exc_info())
+        else:
+            self._step(value, None)
+
+
+def sleep(ircobj, seconds):
+    """Return a Future that is resolved after a number of seconds."""
+    future = Future()
+    ircobj.execute_delayed(seconds, future.set_result, (None,))
+    return future
+
+
+def _report_task_error(task):
+    """[Internal] Print the traceback of a failed handler task."""
+    if task._exc_info:
+        traceback.print_exception(*task._exc_info)
+
+
+class AsyncIRC(IRC):
+    """An IRC object that runs coroutine event handlers.
+
+    Use it like IRC.  Handlers added with add_global_handler (or a
+    connection's add_handler) may return a generator, which is then
+    run as a Task.  Such a handler can't stop the remaining handlers
+    by returning \"NO MORE\".
+    """
+
+    def server(self):
+        """Creates and returns an AsyncServerConnection object."""
+
+        c = AsyncServerConnection(self)
+        self.connections.append(c)
+        return c
+
+    def dcc(self, dcctype="chat"):
+        """Creates and returns an AsyncDCCConnection object.
+
+        Arguments are as for IRC.dcc.
+        """
+        c = AsyncDCCConnection(self, dcctype)
+        self.connections.append(c)
+        return c
+
+    def spawn(self, coroutine):
+        """Run a coroutine (a generator) as a Task.
+
+        Returns the Task.
+        """
+        return Task(self, coroutine)
+
+    def _run_handler(self, result):
+        """[Internal] Start a Task if a handler returned a coroutine."""
+        if type(result) is types.GeneratorType:
+            Task(self, result).add_done_callback(_report_task_error)
+            return None
+        return result
+
+    def _handle_event(self, connection, event):
+        """[Internal]"""
+        for handler in self._handlers_for(event.eventtype()):
+            if self._run_handler(handler(connection, event)) == "NO MORE":
+                return "NO MORE"
+
+
+class AsyncServerConnection(ServerConnection):
+    """An IRC server connection for coroutines.
+
+    AsyncServerConnection objects are instantiated by calling the
+    server method on an AsyncIRC object.
+
+    When more than high_water bytes are waiting to be written,
+    drain() waits until no more than low_water bytes are left.
+    """
+
+    def __init__(self, irclibobj):
+        ServerConnection.__init__(self, irclibobj)
+        self._welcome = None  # Future while waiting for the welcome.
+        self._connect_timer = None
+
+    def connect(self, server, port, nickname, password=None, username=None,
+                ircname=None, localaddress="", localport=0, sock=None,
+                tls=None, timeout=30):
+        """Connect/reconnect to a server without blocking.
+
+        Arguments are as for ServerConnection.connect, plus:
+
+            timeout -- Give up if the server hasn't welcomed us after
+                       this many seconds (None means never).
+
+        Returns a Future, which is resolved with the connection when
+        the server has sent its welcome message.  If the connection
+        fails, the Future gets a ServerConnectionError and a
+        \"disconnect\" event is generated.
+        """
+        future = Future()
+        try:
+            ServerConnection.connect(self, server, port, nickname, password,
+                                     username, ircname, localaddress,
+                                     localport, sock, tls)
+        except ServerConnectionError, x:
+            future.set_exception(x)
+            return future
+        self._welcome = future
+        if timeout is not None:
+            self._connect_timer = self.execute_delayed(
+                timeout, self.disconnect, ("Connection timed out",))
+        return future
+
+    def _stop_waiting(self):
+        """[Internal] Return the welcome Future, if any, and forget it."""
+        future = self._welcome
+        self._welcome = None
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        return future
+
+    def _connect_failed(self, reason):
+        """[Internal]"""
+        future = self._stop_waiting()
+        ServerConnection._connect_failed(self, reason)
+        if future is not None:
+            future.set_exception(ServerConnectionError(reason))
+
+    def disconnect(self, message=""):
+        """Hang up the connection.
+
+        Arguments:
+
+            message -- Quit message.
+        """
+        if not self.connected and not self._connecting:
+            return
+        # Handlers of the disconnect event may reconnect right away,
+        # so take the state of this session out of the way first.
+        future = self._stop_waiting()
+        ServerConnection.disconnect(self, message)
+        if future is not None:
+            future.set_exception(
+                ServerConnectionError(message or "Disconnected"))
+
+    def _wants(self, eventtype):
+        """[Internal]"""
+        # The welcome event resolves the connect() Future.
+        return eventtype == "welcome" \
+               or ServerConnection._wants(self, eventtype)
+
+    def _handle_event(self, event):
+        """[Internal]"""
+        if self.irclibobj._handle_event(self, event) != "NO MORE":
+            for handler in self._handlers_for(event.eventtype()):
+                result = self.irclibobj._run_handler(handler(self, event))
+                if result == "NO MORE":
+                    break
+        if event.eventtype() == "welcome" and self._welcome is not None:
+            self._stop_waiting().set_result(self)
+
+    def drain(self):
+        """Wait for the output buffer to empty out.
+
+        Returns a Future, which is resolved immediately if no more
+        than high_water bytes are buffered, and otherwise when no more
+        than low_water bytes are left.
+        """
+        return _drain(self)
+
+
+class AsyncDCCConnection(DCCConnection):
+    """A DCC connection for coroutines.
+
+    AsyncDCCConnection objects are instantiated by calling the dcc
+    method on an AsyncIRC object.  Its handlers may be coroutines,
+    and drain() works as for AsyncServerConnection.
+    """
+
+    def _handle_event(self, event):
+        """[Internal]"""
+        if self.irclibobj._handle_event(self, event) == "NO MORE":
+            return
+        for handler in self._handlers_for(event.eventtype()):
+            if self.irclibobj._run_handler(handler(self, event)) == "NO MORE":
+                return
+
+    def drain(self):
+        """Wait for the output buffer to empty out; see
+        AsyncServerConnection.drain."""
+        return _drain(self)
+
+
+def _drain(connection):
+    """[Internal] Return a Future for connection.when_drained."""
+    future = Future()
+    def drained(error):
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+    connection.when_drained(drained)
+    return future
+
+
+class AsyncBotMixin:
+    """Mixin class for running a SimpleIRCClient sub class on AsyncIRC.
+
+    Put it first among the base classes:
+
+        class AsyncWolfBot(AsyncBotMixin, WolfBot):
+            pass
+
+    The bot's on_* methods may then be coroutines.
+    """
+
+    irc_class = AsyncIRC
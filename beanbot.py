@@ -15,33 +15,40 @@ via some means (currently UDP).
 
 """
 
-import sys, string, random, time, os, fcntl
+import sys, string, random, time, os, fcntl, socket, errno
 from ircbot import SingleServerIRCBot
 import irclib
 from irclib import nm_to_n, nm_to_h, irc_lower, parse_channel_modes
-from botcommon import OutputManager
-from threading import Thread
+from botcommon import OutputManager, MessageSummary, SUMMARIZE
+from botcommon import strip_formatting
 
 svn_url = \
 "$URL$"
 svn_url = svn_url[svn_url.find(' ')+1:svn_url.rfind('/')+1]
 
 class Bot(SingleServerIRCBot):
+  fixed_handlers = 1
   def __init__(self, channel, nickname, nickpass, ircaddr, udpaddr,
-      debug=False):
-    SingleServerIRCBot.__init__(self, [ircaddr], nickname, nickname, 5)
+      debug=False, max_queued=10, overflow=SUMMARIZE, ircobj=None):
+    SingleServerIRCBot.__init__(self, [ircaddr], nickname, nickname, 5,
+                                ircobj=ircobj)
     self.channel = channel
+    self.join_channels([channel])
     # self.nickname is the nickname we _want_. The nickname we actually
     # have at any particular time is c.get_nickname().
     self.nickname = nickname
     self.nickpass = nickpass
     self.debug = debug
-    self.queue = OutputManager(self.connection, .9)
-    self.queue.start()
-    self.inputthread = UDPInput(self, udpaddr)
-    self.inputthread.start()
+    if debug:
+      self.connection.add_handler("all_events", self._print_event, -20)
+    # A burst of commits shouldn't keep the channel busy for minutes.
+    self.queue = OutputManager(self.connection, .9, max_queued=max_queued,
+        overflow=overflow, summary=CommitSummary)
+    self.input = UDPInput(self, udpaddr)
+
+  def start(self):
     try:
-      self.start()
+      SingleServerIRCBot.start(self)
     except KeyboardInterrupt:
       self.connection.quit("Ctrl-C at console")
       print "Quit IRC."
@@ -70,18 +77,16 @@ class Bot(SingleServerIRCBot):
     'topicinfo': None,
     'ping': None,
     }
-  def _dispatcher(self, c, e):
-    if self.debug:
-      eventtype = e.eventtype()
-      if eventtype not in self._uninteresting_events:
-        source = e.source()
-        if source is not None:
-          source = nm_to_n(source)
-        else:
-          source = ''
-        print "E: %s (%s->%s) %s" % (eventtype, source, e.target(),
-            e.arguments())
-    SingleServerIRCBot._dispatcher(self, c, e)
+  def _print_event(self, c, e):
+    eventtype = e.eventtype()
+    if eventtype not in self._uninteresting_events:
+      source = e.source()
+      if source is not None:
+        source = nm_to_n(source)
+      else:
+        source = ''
+      print "E: %s (%s->%s) %s" % (eventtype, source, e.target(),
+          e.arguments())
 
   def on_nicknameinuse(self, c, e):
     c.nick(c.get_nickname() + "_")
@@ -103,7 +108,6 @@ class Bot(SingleServerIRCBot):
       c.nick(self.nickname)
 
   def on_welcome(self, c, e):
-    c.join(self.channel)
     if self.nickpass and c.get_nickname() != self.nickname:
       # Reclaim our desired nickname
       c.privmsg('nickserv', 'ghost %s %s' % (self.nickname, self.nickpass))
@@ -114,7 +118,8 @@ class Bot(SingleServerIRCBot):
       if e.arguments()[0].find('IDENTIFY') >= 0:
         # Received request to identify
         if self.nickpass and self.nickname == c.get_nickname():
-          self.queue.send('identify %s' % self.nickpass, 'nickserv')
+          self.queue.send('identify %s' % self.nickpass, 'nickserv',
+              OutputManager.CONTROL)
 
   def on_privmsg(self, c, e):
     self.do_command(e, e.arguments()[0])
@@ -175,6 +180,30 @@ class Bot(SingleServerIRCBot):
     self.reply(e, "I don't understand '%s'."%(cmd))
 
 
+class CommitSummary(MessageSummary):
+  """Sums up announcements that didn't fit in the queue.  They come
+  from beanbot-client.py, as "<author> r<rev> <repos> <log>"."""
+
+  def __init__(self):
+    MessageSummary.__init__(self)
+    self.repos = []        # In the order they were seen
+    self.repos_seen = {}
+
+  def add(self, msg):
+    MessageSummary.add(self, msg)
+    words = strip_formatting(msg).split(None, 3)
+    if len(words) >= 3 and words[1][:1] == 'r' and words[1][1:].isdigit() \
+        and words[2] not in self.repos_seen:
+      self.repos_seen[words[2]] = 1
+      self.repos.append(words[2])
+
+  def text(self):
+    if not self.repos:
+      return MessageSummary.text(self)
+    return "...and %d more commits to repos %s" % (self.count,
+        ", ".join(self.repos))
+
+
 botname = 'beanbot'
 
 def usage(exitcode=1):
@@ -221,7 +250,12 @@ def main():
   import ConfigParser
   c = ConfigParser.ConfigParser()
   c.read(configfile)
-  cfgsect = botname
+  bot_from_config(c, botname, debug=debug).start()
+
+def bot_from_config(c, cfgsect, ircobj=None, debug=False):
+  import ConfigParser
+  if c.has_option(cfgsect, 'debug'):
+    debug = debug or c.getboolean(cfgsect, 'debug')
   ircaddr = parse_host_port(c.get(cfgsect, 'host'), 6667)
   channel = c.get(cfgsect, 'channel')
   nickname = c.get(cfgsect, 'nickname')
@@ -230,22 +264,33 @@ def main():
   except ConfigParser.NoOptionError:
     nickpass = None
   udpaddr = parse_host_port(c.get(cfgsect, 'udp-addr'))
+  options = {}
+  if c.has_option(cfgsect, 'queue-limit'):
+    options['max_queued'] = c.getint(cfgsect, 'queue-limit') or None
+  if c.has_option(cfgsect, 'queue-overflow'):
+    options['overflow'] = c.get(cfgsect, 'queue-overflow')
 
-  Bot(channel, nickname, nickpass, ircaddr, udpaddr, debug)
+  return Bot(channel, nickname, nickpass, ircaddr, udpaddr, debug,
+             ircobj=ircobj, **options)
 
 
-class UDPInput(Thread):
+class UDPInput:
+  """Reads messages from a UDP socket in the bot's event loop."""
   def __init__(self, bot, addr):
-    Thread.__init__(self)
-    self.setDaemon(1)
     self.bot = bot
-    from socket import socket, AF_INET, SOCK_DGRAM
-    self.socket = socket(AF_INET, SOCK_DGRAM)
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.socket.bind(addr)
+    self.socket.setblocking(0)
+    bot.ircobj.watch_socket(self.socket, self.process_data)
 
-  def run(self):
+  def process_data(self, sock):
     while 1:
-      data, addr = self.socket.recvfrom(1024)
+      try:
+        data, addr = sock.recvfrom(1024)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          return
+        raise
       self.bot.say_public(data)
 
 if __name__ == "__main__":
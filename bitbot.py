@@ -64,21 +64,19 @@ ponderings = \
 
 
 class BitBot(SingleServerIRCBot):
-  def __init__(self, channel, nickname, server, port):
-    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname)
+  fixed_handlers = 1
+  def __init__(self, channel, nickname, server, port, ircobj=None):
+    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname,
+                                ircobj=ircobj)
     self.channel = channel
+    self.join_channels([channel])
     self.nickname = nickname
     self.queue = botcommon.OutputManager(self.connection)
-    self.queue.start()
-    self.start()
 
   def on_nicknameinuse(self, c, e):
     self.nickname = c.get_nickname() + "_"
     c.nick(self.nickname)
 
-  def on_welcome(self, c, e):
-    c.join(self.channel)
-
   def on_privmsg(self, c, e):
     from_nick = nm_to_n(e.source())
     self.do_command(e, e.arguments()[0], from_nick)
@@ -138,6 +136,9 @@ class BitBot(SingleServerIRCBot):
       self.reply(self.exclaim_something(), target)
 
 
+def bot_from_config(config, section, ircobj=None):
+  return botcommon.trivial_bot_from_config(BitBot, config, section, ircobj)
+
 if __name__ == "__main__":
   try:
     botcommon.trivial_bot_main(BitBot)
@@ -4,31 +4,549 @@ Common bits and pieces used by the various bots.
 
 import sys
 import os
-import time
-from threading import Thread, Event
+import math
+import re
+import threading
+from collections import deque
 
+import irclib
+from irclib import _monotonic
 
-class OutputManager(Thread):
-  def __init__(self, connection, delay=.5):
-    Thread.__init__(self)
-    self.setDaemon(1)
+
+class Histogram:
+  """Counts values in buckets that double in width: below SMALLEST,
+  below twice that, and so on, for BUCKETS buckets.  Meant for
+  latencies in seconds."""
+
+  def __init__(self, smallest=.001, buckets=24):
+    self.smallest = smallest
+    self.counts = [0] * buckets
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, value):
+    if value < self.smallest:
+      i = 0
+    else:
+      i = min(math.frexp(value / self.smallest)[1], len(self.counts) - 1)
+    self.counts[i] = self.counts[i] + 1
+    self.count = self.count + 1
+    self.total = self.total + value
+    self.max = max(self.max, value)
+
+  def mean(self):
+    if not self.count:
+      return 0.0
+    return self.total / self.count
+
+  def bound(self, i):
+    "Return the upper bound of bucket I (None for the last one)."
+    if i == len(self.counts) - 1:
+      return None
+    return self.smallest * 2 ** i
+
+  def percentile(self, p):
+    """Return an upper bound on the Pth percentile: the upper bound of
+    its bucket, or the largest value seen if that is smaller."""
+    if not self.count:
+      return 0.0
+    seen = 0
+    for i in range(len(self.counts)):
+      seen = seen + self.counts[i]
+      if seen * 100.0 >= p * self.count:
+        bound = self.bound(i)
+        if bound is None:
+          return self.max
+        return min(bound, self.max)
+    return self.max
+
+
+class TokenBucket:
+  """Flood control in the manner of an ircd's penalty counter.
+
+  Tokens accrue at RATE per second, up to BURST.  Sending something
+  takes its cost in tokens; the bucket may go into debt for a cost
+  bigger than BURST, which then has to be paid back before anything
+  else goes."""
+
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.stamp = _monotonic()
+
+  def _refill(self):
+    now = _monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+    self.stamp = now
+
+  def wait_time(self, cost):
+    "Return the number of seconds until COST tokens can be taken."
+    self._refill()
+    need = min(cost, self.burst)
+    if self.tokens >= need:
+      return 0
+    return (need - self.tokens) / self.rate
+
+  def take(self, cost):
+    "Take COST tokens."
+    self._refill()
+    self.tokens = self.tokens - cost
+
+
+# IRC formatting codes: bold, color, plain, reverse, italic, underline.
+_format_code_re = re.compile("\x03(?:[0-9]{1,2}(?:,[0-9]{1,2})?)?|[\x02\x0f\x16\x1d\x1f]")
+
+def _format_state(text):
+  "Return the codes that restore the formatting in effect after TEXT."
+  toggles = {}
+  color = ""
+  for m in _format_code_re.finditer(text):
+    code = m.group()
+    if code == "\x0f":
+      toggles = {}
+      color = ""
+    elif code[0] == "\x03":
+      color = code
+    elif code in toggles:
+      del toggles[code]
+    else:
+      toggles[code] = None
+  codes = toggles.keys()
+  codes.sort()
+  if color == "\x03":
+    color = ""
+  return "".join(codes) + color
+
+def strip_formatting(text):
+  "Return TEXT without IRC formatting codes."
+  return _format_code_re.sub("", text)
+
+def split_message(text, limit):
+  """Split TEXT into a head of at most LIMIT bytes and the rest.
+
+  The split is made at a space if there is one in the second half of
+  the head, and never inside a UTF-8 character, nor inside a color
+  code unless the head would be empty otherwise.  The rest starts
+  with the formatting codes in effect at the split, so it looks the
+  same on its own.  Returns (head, rest)."""
+  if len(text) <= limit:
+    return text, ""
+  cut = text.rfind(" ", limit / 2, limit + 1)
+  if cut > 0:
+    head, rest = text[:cut], text[cut+1:]
+  else:
+    cut = limit
+    # Back up to the start of a UTF-8 character...
+    while cut > 0 and ord(text[cut]) & 0xC0 == 0x80:
+      cut = cut - 1
+    char_cut = cut
+    # ...and of a color code.
+    for m in _format_code_re.finditer(text, max(0, cut - 6), cut + 6):
+      if m.start() < cut < m.end():
+        cut = m.start()
+    if cut == 0:
+      # Nothing before the color code: split it rather than the character.
+      cut = char_cut or limit
+    head, rest = text[:cut], text[cut:]
+  return head, _format_state(head) + rest
+
+
+class MessageSummary:
+  """The default OutputManager summary of messages that didn't fit:
+  "...and N more".  Messages are added one at a time, so a sub class
+  keeping more than a count should keep only what its text needs."""
+
+  def __init__(self):
+    self.count = 0
+
+  def add(self, msg):
+    "Count MSG in the summary."
+    self.count = self.count + 1
+
+  def text(self):
+    "Return the summary to send."
+    return "...and %d more" % self.count
+
+
+DROP_OLDEST, DROP_NEWEST, SUMMARIZE = "drop-oldest", "drop-newest", "summarize"
+
+class _Lane:
+  """[Internal] Per-target message queues, served round-robin.
+
+  A queue holds at most LIMIT messages (unless LIMIT is None); see
+  OutputManager for the OVERFLOW policies."""
+
+  def __init__(self, limit=None, overflow=DROP_OLDEST,
+      summary=MessageSummary):
+    self.queues = {}          # target -> deque of messages
+    self.stamps = {}          # target -> deque of their queueing times
+    self.targets = deque()    # targets with queued messages, in turn
+    self.limit = limit
+    self.overflow = overflow
+    self.summary = summary
+    self.summarized = {}      # target -> [queued text, summary object]
+
+  def __len__(self):
+    return len(self.targets)
+
+  def push(self, target, msg):
+    """Queue MSG for TARGET.  Returns the number of messages that
+    won't be sent as they are because the queue was full."""
+    q = self.queues.get(target)
+    if q is None:
+      q = self.queues[target] = deque()
+      self.stamps[target] = deque()
+      self.targets.append(target)
+    stamps = self.stamps[target]
+    summarized = self.summarized.get(target)
+    if summarized is not None and q and q[-1] is summarized[0]:
+      # The summary at the end of the queue hasn't gone out yet.
+      summarized[1].add(msg)
+      q[-1] = summarized[0] = summarized[1].text()
+      return 1
+    if self.limit is None or len(q) < self.limit:
+      q.append(msg)
+      stamps.append(_monotonic())
+      return 0
+    if self.overflow == DROP_NEWEST:
+      return 1
+    if self.overflow == SUMMARIZE:
+      # The last queued message and MSG make way for a summary, which
+      # keeps the last one's place in line.
+      summary = self.summary()
+      summary.add(q.pop())
+      summary.add(msg)
+      text = summary.text()
+      self.summarized[target] = [text, summary]
+      q.append(text)
+      return 2
+    q.popleft()
+    stamps.popleft()
+    q.append(msg)
+    stamps.append(_monotonic())
+    return 1
+
+  def pop(self, target, count=1, rest=None):
+    """Remove the next COUNT messages for TARGET and put REST (if not
+    None) first in its queue.  If TARGET was in turn, the next target
+    gets its turn.  Returns the queueing times of the messages that
+    are gone."""
+    q = self.queues[target]
+    stamps = self.stamps[target]
+    done = []
+    for i in range(count):
+      q.popleft()
+      done.append(stamps.popleft())
+    if rest is not None:
+      q.appendleft(rest)
+      stamps.appendleft(done.pop())
+    if target == self.targets[0]:
+      self.targets.popleft()
+      if q:
+        self.targets.append(target)
+    elif not q:
+      self.targets.remove(target)
+    if not q:
+      del self.queues[target]
+      del self.stamps[target]
+    summarized = self.summarized.get(target)
+    if summarized is not None and not (q and q[-1] is summarized[0]):
+      del self.summarized[target]
+    return done
+
+
+class OutputManager:
+  """Sends PRIVMSGs to a connection without flooding the server.
+
+  Messages go out through a TokenBucket that refills one message's
+  worth every DELAY seconds and holds up to BURST of them, so a few
+  lines go out at once and a long backlog at the server's pace.  Long
+  messages cost more: one token plus one per BYTES_PER_TOKEN bytes.
+
+  Identical messages queued for several targets are sent as one
+  PRIVMSG to up to MAX_TARGETS of them, by default as many as the
+  server's TARGMAX allows.
+
+  With COALESCE on, messages queued for the same target are sent
+  together, separated by SEPARATOR, in as few PRIVMSGs as fit in an
+  IRC line, and messages too long for a line are split.
+
+  Messages are queued by priority: CONTROL (services and the like)
+  goes before PRIVATE, which goes before PUBLIC chatter.  Within a
+  priority each target has its own queue, and targets take turns, so
+  a long backlog for one target doesn't hold up the others.
+
+  With MAX_QUEUED set (to 1 or more; None means no limit), a
+  target's queue holds at most that many messages, and OVERFLOW says
+  what happens to more: DROP_OLDEST drops the oldest queued message,
+  DROP_NEWEST the new one, and SUMMARIZE replaces the last queued
+  message and all that follow with a summary, made by an instance of
+  SUMMARY (a class like MessageSummary, which gives "...and N more")
+  that the messages are added to as they come.
+
+  stats() returns statistics of the queues and what has been sent.
+
+  The OutputManager runs on the IRC object's timers, in the thread
+  that processes events, so one event loop can drive any number of
+  them without threads of their own.  When the connection has more
+  than its high_water mark buffered, sending waits until the socket
+  has taken most of it.  start() is only there for old callers."""
+
+  CONTROL, PRIVATE, PUBLIC = range(3)
+
+  # Room left in a 512 byte line for the ":nick!user@host " prefix the
+  # server adds when it relays a message.
+  prefix_reserve = 100
+  separator = " "
+
+  def __init__(self, connection, delay=.5, burst=5, bytes_per_token=512,
+      coalesce=False, max_targets=None, max_queued=None,
+      overflow=DROP_OLDEST, summary=MessageSummary):
     self.connection = connection
     self.delay = delay
-    self.event = Event()
-    self.queue = []
+    self.bytes_per_token = bytes_per_token
+    self.coalesce = coalesce
+    self.max_targets = max_targets
+    self.bucket = TokenBucket(1.0 / delay, burst)
+    self.lock = threading.RLock()
+    if overflow not in (DROP_OLDEST, DROP_NEWEST, SUMMARIZE):
+      raise ValueError, "Unknown overflow policy %r" % (overflow,)
+    if max_queued is not None and max_queued < 1:
+      raise ValueError, "max_queued must be at least 1, not %r" % (max_queued,)
+    self.lanes = [_Lane(max_queued, overflow, summary)
+                  for priority in range(3)]
+    self.timer = None         # DelayedCommand for _process
+    self.draining = False     # Waiting for the connection to drain
+    self.reset_stats()
+
+  def start(self):
+    pass
+
+  def send(self, msg, target, priority=None):
+    """Queue MSG for TARGET.  PRIORITY is CONTROL, PRIVATE or PUBLIC;
+    by default it is PUBLIC for channels and PRIVATE for nicks."""
+    if priority is None:
+      if self.connection.features.is_channel(target):
+        priority = self.PUBLIC
+      else:
+        priority = self.PRIVATE
+    self.lock.acquire()
+    try:
+      self.overflowed = self.overflowed + \
+          self.lanes[priority].push(target, msg.strip())
+      if self.timer is None and not self.draining:
+        self.timer = self.connection.execute_delayed(0, self._process)
+    finally:
+      self.lock.release()
+
+  def reset_stats(self):
+    "Reset the counters returned by stats."
+    self.lock.acquire()
+    try:
+      self.stats_start = _monotonic()
+      self.latency = Histogram()
+      self.messages_sent = 0
+      self.lines_sent = 0
+      self.bytes_sent = 0
+      self.dropped = 0
+      self.overflowed = 0
+    finally:
+      self.lock.release()
 
-  def run(self):
-    while 1:
-      self.event.wait()
-      while self.queue:
-        msg,target = self.queue.pop(0)
-        self.connection.privmsg(target, msg)
-        time.sleep(self.delay)
-      self.event.clear()
+  def stats(self):
+    """Return a dictionary of statistics since the OutputManager was
+    created or reset_stats was called:
 
-  def send(self, msg, target):
-    self.queue.append((msg.strip(),target))
-    self.event.set()
+      queued -- A dictionary from target to the number of messages
+                queued for it.
+      messages -- Messages sent (as given to send()).
+      lines -- PRIVMSG lines written for them.
+      bytes -- Bytes in those lines.
+      dropped -- Messages dropped because the connection was down.
+      overflowed -- Messages dropped or summarized because their
+                    queue was full.
+      lines_per_second, bytes_per_second -- Rates of the above.
+      latency -- A Histogram of the seconds messages spent queued.
+      connection -- The connection's get_stats()."""
+    self.lock.acquire()
+    try:
+      queued = {}
+      for lane in self.lanes:
+        for target, q in lane.queues.items():
+          queued[target] = queued.get(target, 0) + len(q)
+      elapsed = max(_monotonic() - self.stats_start, 1e-9)
+      return {"queued": queued,
+              "messages": self.messages_sent,
+              "lines": self.lines_sent,
+              "bytes": self.bytes_sent,
+              "dropped": self.dropped,
+              "overflowed": self.overflowed,
+              "lines_per_second": self.lines_sent / elapsed,
+              "bytes_per_second": self.bytes_sent / elapsed,
+              "latency": self.latency,
+              "connection": self.connection.get_stats()}
+    finally:
+      self.lock.release()
+
+  def format_stats(self):
+    "Return the statistics as a list of lines of text."
+    s = self.stats()
+    latency = s["latency"]
+    c = s["connection"]
+    queued = s["queued"].items()
+    queued.sort()
+    return [
+      "queued: %d (%s)" % (sum(s["queued"].values()),
+                           ", ".join(["%s %d" % x for x in queued])),
+      "sent: %d messages in %d lines, %d bytes; %.2f lines/s, %.0f bytes/s;"
+      " %d dropped, %d overflowed"
+      % (s["messages"], s["lines"], s["bytes"], s["lines_per_second"],
+         s["bytes_per_second"], s["dropped"], s["overflowed"]),
+      "queue wait: mean %.3fs, 50%% < %.3fs, 90%% < %.3fs, 99%% < %.3fs,"
+      " max %.3fs" % (latency.mean(), latency.percentile(50),
+                      latency.percentile(90), latency.percentile(99),
+                      latency.max),
+      "socket: %d writes, %d partial, %d blocked, %d bytes buffered,"
+      " %d bytes dropped"
+      % (c["writes"], c["partial_writes"], c["blocked_writes"],
+         c["buffered"], c["dropped"]),
+      ]
+
+  def cost(self, msg, target):
+    "Return the number of tokens it takes to send MSG to TARGET."
+    length = len("PRIVMSG %s :%s\r\n" % (target, msg))
+    return 1 + float(length) / self.bytes_per_token
+
+  def max_text_length(self, target):
+    "Return the longest message that fits in a line to TARGET."
+    return 510 - self.prefix_reserve - len("PRIVMSG %s :" % target)
+
+  def targets_per_message(self):
+    """Return the most targets to put in one PRIVMSG: MAX_TARGETS if
+    given, otherwise what the server allows (None for no limit)."""
+    if self.max_targets:
+      return self.max_targets
+    return self.connection.features.max_targets("PRIVMSG")
+
+  def _next_message(self, lane, target):
+    """Return (text, count, rest): what to send next to TARGET from
+    LANE, made of its next COUNT messages, leaving REST (unless None)
+    at the head of its queue."""
+    q = lane.queues[target]
+    text = q[0]
+    if not self.coalesce:
+      return text, 1, None
+    limit = self.max_text_length(target)
+    if len(text) > limit:
+      head, rest = split_message(text, limit)
+      return head, 1, rest
+    count = 1
+    while count < len(q):
+      more = q[count]
+      if more:
+        if not text:
+          longer = more
+        elif _format_code_re.search(text):
+          longer = text + "\x0f" + self.separator + more
+        else:
+          longer = text + self.separator + more
+        if len(longer) > limit:
+          break
+        text = longer
+      count = count + 1
+    return text, count, None
+
+  def _fan_out(self, lane, target, text):
+    """Return [(target, count)] for the other targets in LANE whose
+    next message is also TEXT, as many as can share a PRIVMSG with
+    TARGET."""
+    room = self.targets_per_message()
+    if room is not None:
+      room = room - 1
+      if room <= 0:
+        return []
+    # The line grows by a comma and a target per target.
+    length = len("PRIVMSG %s :%s" % (target, text))
+    limit = 510 - self.prefix_reserve
+    others = []
+    for other in lane.targets:
+      if room is not None and len(others) >= room:
+        break
+      if other == target or length + 1 + len(other) > limit:
+        continue
+      other_text, count, rest = self._next_message(lane, other)
+      if other_text == text and rest is None:
+        others.append((other, count))
+        length = length + 1 + len(other)
+    return others
+
+  def _next_lane(self):
+    for lane in self.lanes:
+      if lane:
+        return lane
+    return None
+
+  def _drained(self, error):
+    self.lock.acquire()
+    try:
+      self.draining = False
+      if self.timer is None and self._next_lane() is not None:
+        self.timer = self.connection.execute_delayed(0, self._process)
+    finally:
+      self.lock.release()
+
+  def _process(self):
+    # Take what the bucket allows off the queues, then send it
+    # without holding the lock.
+    out = []
+    self.lock.acquire()
+    try:
+      self.timer = None
+      if self.connection.get_buffer_size() > self.connection.high_water:
+        # The socket isn't keeping up; queued messages can still be
+        # coalesced or reordered by priority while we wait.
+        self.draining = True
+        self.connection.when_drained(self._drained)
+        return
+      lane = self._next_lane()
+      while lane is not None:
+        target = lane.targets[0]
+        msg, count, rest = self._next_message(lane, target)
+        others = []
+        if rest is None:
+          others = self._fan_out(lane, target, msg)
+        targets = [target] + [t for t, n in others]
+        cost = self.cost(msg, ",".join(targets))
+        wait = self.bucket.wait_time(cost)
+        if wait > 0:
+          self.timer = self.connection.execute_delayed(wait, self._process)
+          break
+        self.bucket.take(cost)
+        stamps = lane.pop(target, count, rest)
+        for other, n in others:
+          stamps.extend(lane.pop(other, n))
+        out.append((targets, msg, stamps))
+        lane = self._next_lane()
+    finally:
+      self.lock.release()
+    for targets, msg, stamps in out:
+      try:
+        if len(targets) == 1:
+          self.connection.privmsg(targets[0], msg)
+        else:
+          self.connection.privmsg_many(targets, msg)
+      except irclib.ServerNotConnectedError:
+        self.dropped = self.dropped + len(stamps)
+        continue
+      now = _monotonic()
+      for stamp in stamps:
+        self.latency.add(now - stamp)
+      self.messages_sent = self.messages_sent + len(stamps)
+      self.lines_sent = self.lines_sent + 1
+      self.bytes_sent = self.bytes_sent + \
+          len("PRIVMSG %s :%s\r\n" % (",".join(targets), msg))
 
 
 def trivial_bot_main(klass):
@@ -51,3 +569,18 @@ def trivial_bot_main(klass):
   nickname = sys.argv[3]
 
   klass(channel, nickname, server, port).start()
+
+def trivial_bot_from_config(klass, config, section, ircobj=None):
+  """Create a bot the way trivial_bot_main does, but from SECTION of
+  CONFIG (a ConfigParser) with the options host (server[:port]),
+  channel and nickname.  The bot runs on IRCOBJ, an irclib.IRC shared
+  with other bots, if given; KLASS is called as klass(channel,
+  nickname, server, port, ircobj)."""
+  s = config.get(section, "host").split(":", 1)
+  server = s[0]
+  if len(s) == 2:
+    port = int(s[1])
+  else:
+    port = 6667
+  return klass(config.get(section, "channel"),
+               config.get(section, "nickname"), server, port, ircobj)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Run several of the bots in one process.
+#
+
+"""Run several bots on one shared IRC event loop.
+
+Usage: bothost.py [<config-file>]
+
+The config file (bothost.conf by default) has a section per bot.  The
+module option names the bot's module (pinkybot, wolfbot, beanbot, ...);
+the other options are the ones that bot reads from its own config
+file, or host (server[:port]), channel and nickname for the bots that
+otherwise take them on the command line.  See bothost.conf.template.
+
+All the bots share one irclib.IRC object, and so one thread and one
+poll loop; each has its own server connection and only sees its own
+events.
+"""
+
+import ConfigParser
+import sys
+
+import irclib
+
+
+def load_bots(config, ircobj):
+  """Create a bot on IRCOBJ for each section of CONFIG, by calling
+  bot_from_config(config, section, ircobj) in the module it names."""
+  bots = []
+  for section in config.sections():
+    module = __import__(config.get(section, "module"))
+    bots.append(module.bot_from_config(config, section, ircobj))
+  return bots
+
+def main():
+  if len(sys.argv) > 2:
+    print __doc__
+    sys.exit(1)
+  if len(sys.argv) == 2:
+    configfile = sys.argv[1]
+  else:
+    configfile = "bothost.conf"
+
+  config = ConfigParser.ConfigParser()
+  if not config.read(configfile):
+    print "Error: Can't read %s." % configfile
+    sys.exit(1)
+
+  ircobj = irclib.IRC()
+  bots = load_bots(config, ircobj)
+  if not bots:
+    print "Error: No bots in %s." % configfile
+    sys.exit(1)
+  for bot in bots:
+    bot.start_connecting()
+  try:
+    ircobj.process_forever()
+  except KeyboardInterrupt:
+    for bot in bots:
+      bot.connection.quit("Ctrl-C at console")
+    print "Quit IRC."
+
+if __name__ == "__main__":
+  main()
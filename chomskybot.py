@@ -11,17 +11,15 @@ import logging
 import quote_scrape
 
 class ChomskyBot(SingleServerIRCBot):
-  def __init__(self, quotes, channel, nickname, server, port):
-    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname)
+  fixed_handlers = 1
+  def __init__(self, quotes, channel, nickname, server, port, ircobj=None):
+    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname,
+                                ircobj=ircobj)
     self.quotes = quotes
     self.channel = channel
+    self.join_channels([channel])
     self.nickname = nickname
     self.queue = botcommon.OutputManager(self.connection)
-    self.queue.start()
-    self.start()
-
-  def on_welcome(self, c, e):
-    c.join(self.channel)
 
   def on_pubmsg(self, c, e):
     from_nick = nm_to_n(e.source())
@@ -41,6 +39,20 @@ class ChomskyBot(SingleServerIRCBot):
     self.queue.send(text, self.channel)
 
 
+# Goodreads author id of Noam Chomsky.
+default_author_id = 2476
+
+def bot_from_config(config, section, ircobj=None):
+  """Create a ChomskyBot from SECTION of CONFIG: the options are as for
+  botcommon.trivial_bot_from_config, plus an optional author-id to
+  take the quotes from."""
+  author_id = default_author_id
+  if config.has_option(section, "author-id"):
+    author_id = config.getint(section, "author-id")
+  quotes = quote_scrape.ScrapeQuotes(author_id)
+  return botcommon.trivial_bot_from_config(
+      lambda *args: ChomskyBot(quotes, *args), config, section, ircobj)
+
 def main():
   logging.basicConfig(level=logging.DEBUG)
   args = sys.argv[1:]
@@ -49,7 +61,7 @@ def main():
     return
 
   server, port, channel, nickname = args
-  quotes = quote_scrape.ScrapeQuotes(2476)
+  quotes = quote_scrape.ScrapeQuotes(default_author_id)
 
   try:
     bot = ChomskyBot(quotes, channel, nickname, server, int(port))
@@ -43,21 +43,21 @@ story_file = "/Users/sussman/projects/public_html/if/shortlist-games/zork1.z3"
 
 
 class IFBot(SingleServerIRCBot):
-  def __init__(self, channel, nickname, server, port):
+  fixed_handlers = 1
+  def __init__(self, channel, nickname, server, port, ircobj=None):
     self.child = pexpect.spawn(frotz_binary + " " + story_file)
-    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname)
+    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname,
+                                ircobj=ircobj)
     self.channel = channel
+    self.join_channels([channel])
     self.nickname = nickname
-    self.queue = botcommon.OutputManager(self.connection)
-    self.queue.start()
-    self.start()
+    self.queue = botcommon.OutputManager(self.connection, coalesce=True)
 
   def on_nicknameinuse(self, c, e):
     self.nickname = c.get_nickname() + "_"
     c.nick(self.nickname)
 
   def on_welcome(self, c, e):
-    c.join(self.channel)
     self.child.expect(prompts)
     for line in self.child.before.splitlines():
       self.reply(line)
@@ -109,6 +109,9 @@ class IFBot(SingleServerIRCBot):
       print self.child.before
 
 
+def bot_from_config(config, section, ircobj=None):
+  return botcommon.trivial_bot_from_config(IFBot, config, section, ircobj)
+
 if __name__ == "__main__":
   try:
     botcommon.trivial_bot_main(IFBot)
@@ -24,13 +24,141 @@ This module contains a single-server IRC bot class that can be used to
 write simpler bots.
 """
 
+import random
 import sys
-from UserDict import UserDict
 
 from irclib import SimpleIRCClient
-from irclib import nm_to_n, irc_lower, all_events
-from irclib import parse_channel_modes, is_channel
+from irclib import irc_lower, all_events
 from irclib import ServerConnectionError
+from irclib import _monotonic, _irc_lower_table
+
+class ReconnectPolicy:
+    """Decides when a SingleServerIRCBot reconnects, and to what.
+
+    This class waits a fixed interval before each attempt; see
+    ExponentialBackoff for a better one.  The bot calls attempt()
+    when it starts connecting to a server, connected() when the
+    server has welcomed it, and disconnected() when the connection is
+    lost or couldn't be made.  Servers are (host, port) tuples.
+
+    Each server has a score, the number of times in a row it has
+    failed us; order() puts the servers with the lowest scores first.
+
+    get_stats() tells how reconnecting has gone.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.scores = {}             # server -> failures in a row
+        self._connected_at = None    # When we were last welcomed.
+        self._down_since = None      # When we were last disconnected.
+        self.reset_stats()
+
+    def delay(self):
+        """Return the seconds to wait before the next attempt."""
+        return self.interval
+
+    def order(self, server_list):
+        """Sort server_list (of server_list entries) in place, so that
+        the most reliable servers come first."""
+        server_list.sort(key=lambda entry: self.scores.get(entry[:2], 0))
+
+    def attempt(self, server):
+        """A connection to server is being attempted."""
+        self._attempts = self._attempts + 1
+
+    def connected(self, server):
+        """The server has welcomed us."""
+        now = _monotonic()
+        if self._down_since is not None:
+            t = now - self._down_since
+            self._down_since = None
+            self._reconnects = self._reconnects + 1
+            self._reconnect_time = self._reconnect_time + t
+            self._max_reconnect_time = max(self._max_reconnect_time, t)
+        self._connected_at = now
+
+    def disconnected(self, server):
+        """The connection to server was lost, or couldn't be made."""
+        now = _monotonic()
+        if self._connected_at is None:
+            self._failures = self._failures + 1
+            self.scores[server] = self.scores.get(server, 0) + 1
+        else:
+            self.scores[server] = 0
+            self._connected_at = None
+        if self._down_since is None:
+            self._down_since = now
+
+    def reset_stats(self):
+        """Reset the counters returned by get_stats."""
+        self._attempts = 0
+        self._failures = 0
+        self._reconnects = 0
+        self._reconnect_time = 0.0
+        self._max_reconnect_time = 0.0
+
+    def get_stats(self):
+        """Return a dictionary of reconnection statistics.
+
+        The keys are:
+
+            attempts -- Connection attempts.
+
+            failures -- Attempts that didn't get us welcomed.
+
+            reconnects -- Times we got back after being disconnected.
+
+            mean_reconnect_time, max_reconnect_time -- Seconds from
+                being disconnected to being welcomed again.
+
+            down_for -- Seconds we have been disconnected, or None.
+        """
+        down_for = None
+        if self._down_since is not None:
+            down_for = _monotonic() - self._down_since
+        return {"attempts": self._attempts,
+                "failures": self._failures,
+                "reconnects": self._reconnects,
+                "mean_reconnect_time":
+                    self._reconnect_time / max(self._reconnects, 1),
+                "max_reconnect_time": self._max_reconnect_time,
+                "down_for": down_for}
+
+
+class ExponentialBackoff(ReconnectPolicy):
+    """A ReconnectPolicy that backs off exponentially, with jitter.
+
+    After n failures in a row, the delay is random between 0 and
+    base * 2**n seconds, but at most cap seconds ("full jitter"), so
+    that bots that lost their server at the same time don't all come
+    back at the same time.  A connection counts as a failure unless it
+    stayed up for stable_after seconds.
+    """
+
+    def __init__(self, base=2, cap=300, stable_after=300):
+        ReconnectPolicy.__init__(self, cap)
+        self.base = base
+        self.cap = cap
+        self.stable_after = stable_after
+        self.failures = 0            # Failures in a row.
+
+    def delay(self):
+        return random.uniform(0, min(self.cap,
+                                     self.base * 2 ** min(self.failures, 30)))
+
+    def disconnected(self, server):
+        connected_at = self._connected_at
+        ReconnectPolicy.disconnected(self, server)
+        if connected_at is not None \
+               and _monotonic() - connected_at >= self.stable_after:
+            self.failures = 0
+        else:
+            self.failures = self.failures + 1
+            if connected_at is not None:
+                # Welcomed, but dropped again soon.
+                self.scores[server] = self.scores.get(server, 0) + 1
+
 
 class SingleServerIRCBot(SimpleIRCClient):
     """A single-server IRC bot class.
@@ -41,8 +169,39 @@ class SingleServerIRCBot(SimpleIRCClient):
     clients that are present in the channels and which of those that
     have operator or voice modes.  The "database" is kept in the
     self.channels attribute, which is an IRCDict of Channels.
+
+    The channels the bot should be in are kept in the
+    wanted_channels attribute, an IRCDict from channel names to keys
+    ("" for none); see join_channels.  After each (re)connect, the
+    bot joins them all with as few JOIN commands as the server
+    takes.  The server's limits are in its ISUPPORT (005) messages,
+    which come before the end of its MOTD, so the joins wait for
+    that, or for registration_timeout seconds after the welcome if
+    the server doesn't say.  resync_channels() refreshes the member
+    lists.
+
+    The bot PINGs the server every keepalive_interval seconds, and
+    reconnects if the PONG takes more than max_lag seconds; see
+    ServerConnection.set_keepalive.
+
+    With race_servers above 1, the bot connects to whichever of the
+    first race_servers servers in server_list answers first.  The
+    connects start race_stagger seconds apart (or as soon as the one
+    before fails) and are given up after race_timeout seconds.
+
+    With tls set to an ssl.SSLContext, or true for the default
+    settings, the bot connects with TLS.
     """
-    def __init__(self, server_list, nickname, realname, reconnection_interval=60):
+
+    keepalive_interval = 30
+    max_lag = 60
+    race_stagger = .25
+    race_timeout = 30
+    registration_timeout = 10
+    tls = None
+
+    def __init__(self, server_list, nickname, realname, reconnection_interval=60,
+                 race_servers=1, reconnect_policy=None, ircobj=None):
         """Constructor for SingleServerIRCBot objects.
 
         Arguments:
@@ -55,60 +214,148 @@ class SingleServerIRCBot(SimpleIRCClient):
 
             realname -- The bot's realname.
 
-            reconnection_interval -- How long the bot should wait
+            reconnection_interval -- The longest the bot should wait
                                      before trying to reconnect.
 
+            race_servers -- How many servers to try at once.
+
+            reconnect_policy -- A ReconnectPolicy deciding when to
+                                reconnect, and to which servers
+                                first.  The default is an
+                                ExponentialBackoff capped at
+                                reconnection_interval.
+
+            ircobj -- An IRC instance to share with other bots
+                      (optional).  By default the bot gets one of
+                      its own.
+
             dcc_connections -- A list of initiated/accepted DCC
             connections.
         """
 
-        SimpleIRCClient.__init__(self)
+        SimpleIRCClient.__init__(self, ircobj)
         self.channels = IRCDict()
         self.server_list = server_list
         if not reconnection_interval or reconnection_interval < 0:
             reconnection_interval = 2**31
         self.reconnection_interval = reconnection_interval
+        if reconnect_policy is None:
+            if reconnection_interval == 2**31:
+                # Effectively never.
+                reconnect_policy = ReconnectPolicy(reconnection_interval)
+            else:
+                reconnect_policy = ExponentialBackoff(
+                    cap=reconnection_interval)
+        self.reconnect_policy = reconnect_policy
+        self.race_servers = race_servers
+        self._reconnect_timer = None
+        self._race = None
+        self.wanted_channels = IRCDict()
+        self._registered = 0  # Registration is over, ISUPPORT known.
+        self._registration_timer = None
+        self._resyncing = IRCDict()  # Channels waiting for NAMES replies.
 
         self._nickname = nickname
         self._realname = realname
-        for i in ["disconnect", "join", "kick", "mode",
-                  "namreply", "nick", "part", "quit"]:
-            self.connection.add_global_handler(i,
-                                               getattr(self, "_on_" + i),
-                                               -10)
-    def _connected_checker(self):
+        self.connection.set_keepalive(self.keepalive_interval, self.max_lag)
+        for i in ["disconnect", "endofmotd", "endofnames", "featurelist",
+                  "join", "kick", "mode", "namreply", "nick", "nomotd",
+                  "part", "quit", "welcome"]:
+            self.connection.add_handler(i, getattr(self, "_on_" + i), -10)
+    def _reconnect(self):
         """[Internal]"""
-        if not self.connection.is_connected():
-            self.connection.execute_delayed(self.reconnection_interval,
-                                            self._connected_checker)
-            self.jump_server()
+        self._reconnect_timer = None
+        # An attempt in progress ends by connecting or by failing,
+        # which schedules the next one (a stalled connect fails after
+        # connection.connect_timeout seconds).
+        if self.connection.is_connected() or self.connection._connecting \
+               or self._race is not None:
+            return
+        self.jump_server()
+
+    def _schedule_reconnect(self):
+        """[Internal] Try the next server after the policy's delay."""
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+        self._reconnect_timer = self.connection.execute_delayed(
+            self.reconnect_policy.delay(), self._reconnect)
 
     def _connect(self):
         """[Internal]"""
+        if self._race is not None:
+            self._race.cancel()
+            self._race = None
+        if self.race_servers > 1 and len(self.server_list) > 1:
+            servers = self.server_list[:self.race_servers]
+            for server in servers:
+                self.reconnect_policy.attempt(server[:2])
+            self._race = self.ircobj.race_connect(
+                [server[:2] for server in servers],
+                lambda sock, i: self._race_done(servers, sock, i),
+                self.race_stagger, self.race_timeout)
+            return
         password = None
         if len(self.server_list[0]) > 2:
             password = self.server_list[0][2]
+        self.reconnect_policy.attempt(self.server_list[0][:2])
         try:
             self.connect(self.server_list[0][0],
                          self.server_list[0][1],
                          self._nickname,
                          password,
-                         ircname=self._realname)
+                         ircname=self._realname,
+                         tls=self.tls)
         except ServerConnectionError:
-            pass
+            self.reconnect_policy.disconnected(self.server_list[0][:2])
+            self._schedule_reconnect()
+
+    def _race_done(self, servers, sock, i):
+        """[Internal]"""
+        self._race = None
+        if sock is None:
+            for server in servers:
+                self.reconnect_policy.disconnected(server[:2])
+            self._schedule_reconnect()
+            return
+        # Put the winner first, so that jump_server moves on from it.
+        server = servers[i]
+        if server in self.server_list:
+            self.server_list.remove(server)
+            self.server_list.insert(0, server)
+        password = None
+        if len(server) > 2:
+            password = server[2]
+        try:
+            self.connect(server[0], server[1], self._nickname, password,
+                         ircname=self._realname, sock=sock, tls=self.tls)
+        except ServerConnectionError:
+            self.reconnect_policy.disconnected(server[:2])
+            self._schedule_reconnect()
 
     def _on_disconnect(self, c, e):
         """[Internal]"""
         self.channels = IRCDict()
-        self.connection.execute_delayed(self.reconnection_interval,
-                                        self._connected_checker)
+        self._registered = 0
+        self._stop_registration_timer()
+        self._resyncing = IRCDict()
+        self.reconnect_policy.disconnected((c.server, c.port))
+        self._schedule_reconnect()
+
+    def _on_featurelist(self, c, e):
+        """[Internal]"""
+        # Names are compared the way the server says.
+        casemapping = c.features.casemapping
+        for d in self.channels, self.wanted_channels, self._resyncing:
+            d.set_casemapping(casemapping)
+        for ch in self.channels.values():
+            ch.set_casemapping(casemapping)
 
     def _on_join(self, c, e):
         """[Internal]"""
         ch = e.target()
-        nick = nm_to_n(e.source())
+        nick = e.nick
         if nick == c.get_nickname():
-            self.channels[ch] = Channel()
+            self.channels[ch] = Channel(c.features.casemapping)
         self.channels[ch].add_user(nick)
 
     def _on_kick(self, c, e):
@@ -123,9 +370,9 @@ class SingleServerIRCBot(SimpleIRCClient):
 
     def _on_mode(self, c, e):
         """[Internal]"""
-        modes = parse_channel_modes(" ".join(e.arguments()))
+        modes = c.features.parse_channel_modes(" ".join(e.arguments()))
         t = e.target()
-        if is_channel(t):
+        if c.features.is_channel(t):
             ch = self.channels[t]
             for mode in modes:
                 if mode[0] == "+":
@@ -147,18 +394,25 @@ class SingleServerIRCBot(SimpleIRCClient):
         # e.arguments()[2] == nick list
 
         ch = e.arguments()[1]
+        if ch in self._resyncing:
+            # The first reply to resync_channels replaces what we knew.
+            del self._resyncing[ch]
+            self.channels[ch].clear_users()
+        statuses = {}
+        for mode, symbol in c.features.prefix:
+            statuses[symbol] = mode
         for nick in e.arguments()[2].split():
-            if nick[0] == "@":
-                nick = nick[1:]
-                self.channels[ch].set_mode("o", nick)
-            elif nick[0] == "+":
+            # With multi-prefix there may be several symbols.
+            while nick and nick[0] in statuses:
+                mode = statuses[nick[0]]
                 nick = nick[1:]
-                self.channels[ch].set_mode("v", nick)
+                if mode in "ov":
+                    self.channels[ch].set_mode(mode, nick)
             self.channels[ch].add_user(nick)
 
     def _on_nick(self, c, e):
         """[Internal]"""
-        before = nm_to_n(e.source())
+        before = e.nick
         after = e.target()
         for ch in self.channels.values():
             if ch.has_user(before):
@@ -166,7 +420,7 @@ class SingleServerIRCBot(SimpleIRCClient):
 
     def _on_part(self, c, e):
         """[Internal]"""
-        nick = nm_to_n(e.source())
+        nick = e.nick
         channel = e.target()
 
         if nick == c.get_nickname():
@@ -174,13 +428,105 @@ class SingleServerIRCBot(SimpleIRCClient):
         else:
             self.channels[channel].remove_user(nick)
 
+    def _on_endofnames(self, c, e):
+        """[Internal]"""
+        ch = e.arguments()[0]
+        if ch in self._resyncing:
+            del self._resyncing[ch]
+
+    def _on_welcome(self, c, e):
+        """[Internal]"""
+        self.reconnect_policy.connected((c.server, c.port))
+        self._stop_registration_timer()
+        self._registration_timer = c.execute_delayed(
+            self.registration_timeout, self._registration_done)
+
+    def _on_endofmotd(self, c, e):
+        """[Internal]"""
+        self._registration_done()
+
+    _on_nomotd = _on_endofmotd
+
+    def _registration_done(self):
+        """[Internal] The server has said what it supports, or had
+        the time to."""
+        self._stop_registration_timer()
+        if self._registered:
+            return
+        self._registered = 1
+        self._join_wanted(self.wanted_channels.keys())
+
+    def _stop_registration_timer(self):
+        """[Internal]"""
+        if self._registration_timer is not None:
+            self._registration_timer.cancel()
+            self._registration_timer = None
+
     def _on_quit(self, c, e):
         """[Internal]"""
-        nick = nm_to_n(e.source())
+        nick = e.nick
         for ch in self.channels.values():
             if ch.has_user(nick):
                 ch.remove_user(nick)
 
+    def join_channels(self, channels, keys=None):
+        """Join channels, and join them again after each reconnect.
+
+        Arguments:
+
+            channels -- A list of channel names.
+
+            keys -- A dictionary from channel names to keys, for the
+                    channels that need one (optional).
+
+        The channels are added to wanted_channels.  Those the bot
+        isn't in are joined with as few JOIN commands as possible
+        (see ServerConnection.join_channels), right away if the bot
+        is connected and otherwise when it is.
+        """
+        keys = keys or {}
+        for ch in channels:
+            self.wanted_channels[ch] = keys.get(ch, "")
+        self._join_wanted(channels)
+
+    def part_channels(self, channels, message=""):
+        """Leave channels, and stop joining them after reconnects.
+
+        The channels the bot is in are left with as few PART
+        commands as possible.
+        """
+        for ch in channels:
+            if ch in self.wanted_channels:
+                del self.wanted_channels[ch]
+        if self._registered:
+            self.connection.part_channels(
+                [ch for ch in channels if ch in self.channels], message)
+
+    def resync_channels(self):
+        """Refresh the member lists of the channels the bot is in.
+
+        The server is asked for the names of all of them, with as few
+        NAMES commands as it takes, and each list is replaced by the
+        answer.
+        """
+        if not self._registered or not self.channels:
+            return
+        channels = self.channels.keys()
+        for ch in channels:
+            self._resyncing[ch] = 1
+        self.connection.names(channels)
+
+    def _join_wanted(self, channels):
+        """[Internal] Join the wanted channels among channels."""
+        if not self._registered:
+            return
+        channels = [ch for ch in channels
+                    if ch in self.wanted_channels and ch not in self.channels]
+        keys = {}
+        for ch in channels:
+            keys[ch] = self.wanted_channels[ch]
+        self.connection.join_channels(channels, keys)
+
     def die(self, msg="Bye, cruel world!"):
         """Let the bot die.
 
@@ -220,6 +566,7 @@ class SingleServerIRCBot(SimpleIRCClient):
             self.connection.disconnect(msg)
 
         self.server_list.append(self.server_list.pop(0))
+        self.reconnect_policy.order(self.server_list)
         self._connect()
 
     def on_ctcp(self, c, e):
@@ -229,11 +576,11 @@ class SingleServerIRCBot(SimpleIRCClient):
         to the on_dccchat method.
         """
         if e.arguments()[0] == "VERSION":
-            c.ctcp_reply(nm_to_n(e.source()),
+            c.ctcp_reply(e.nick,
                          "VERSION " + self.get_version())
         elif e.arguments()[0] == "PING":
             if len(e.arguments()) > 1:
-                c.ctcp_reply(nm_to_n(e.source()),
+                c.ctcp_reply(e.nick,
                              "PING " + e.arguments()[1])
         elif e.arguments()[0] == "DCC" and e.arguments()[1].split(" ", 1)[0] == "CHAT":
             self.on_dccchat(c, e)
@@ -243,69 +590,104 @@ class SingleServerIRCBot(SimpleIRCClient):
 
     def start(self):
         """Start the bot."""
-        self._connect()
+        self.start_connecting()
         SimpleIRCClient.start(self)
 
+    def start_connecting(self):
+        """Start connecting, without running the event loop.
+
+        For a bot whose IRC object runs its event loop elsewhere, for
+        example one shared with other bots; start() does this and
+        then runs the loop.
+        """
+        self._connect()
+
 
 class IRCDict:
     """A dictionary suitable for storing IRC-related things.
 
     Dictionary keys a and b are considered equal if and only if
-    irc_lower(a) == irc_lower(b)
+    irc_lower(a, casemapping) == irc_lower(b, casemapping), where
+    casemapping is \"rfc1459\" (the default), \"strict-rfc1459\" or
+    \"ascii\", as a server's CASEMAPPING feature says.  The keys are
+    returned as they were last set.
 
     Otherwise, it should behave exactly as a normal dictionary.
+
+    The values are kept under the lowercased keys, and the keys as
+    they were set only where they aren't lowercase already.
     """
 
-    def __init__(self, dict=None):
-        self.data = {}
-        self.canon_keys = {}  # Canonical keys
+    def __init__(self, dict=None, casemapping="rfc1459"):
+        self.data = {}  # Lowercased key -> value
+        self._keys = {}  # Lowercased key -> key, where they differ
+        self.casemapping = casemapping
+        self._table = _irc_lower_table(casemapping)
         if dict is not None:
             self.update(dict)
+    def set_casemapping(self, casemapping):
+        """Compare keys the way a server with this casemapping does."""
+        if casemapping == self.casemapping:
+            return
+        items = self.items()
+        self.data = {}
+        self._keys = {}
+        self.casemapping = casemapping
+        self._table = _irc_lower_table(casemapping)
+        for key, value in items:
+            self[key] = value
     def __repr__(self):
-        return repr(self.data)
-    def __cmp__(self, dict):
-        if isinstance(dict, IRCDict):
-            return cmp(self.data, dict.data)
-        else:
-            return cmp(self.data, dict)
+        return repr(dict(self.items()))
+    def __cmp__(self, other):
+        if isinstance(other, IRCDict):
+            other = dict(other.items())
+        return cmp(dict(self.items()), other)
     def __len__(self):
         return len(self.data)
     def __getitem__(self, key):
-        return self.data[self.canon_keys[irc_lower(key)]]
+        return self.data[key.translate(self._table)]
     def __setitem__(self, key, item):
-        if key in self:
-            del self[key]
-        self.data[key] = item
-        self.canon_keys[irc_lower(key)] = key
+        lower = key.translate(self._table)
+        self.data[lower] = item
+        if lower != key:
+            self._keys[lower] = key
+        elif lower in self._keys:
+            del self._keys[lower]
     def __delitem__(self, key):
-        ck = irc_lower(key)
-        del self.data[self.canon_keys[ck]]
-        del self.canon_keys[ck]
+        lower = key.translate(self._table)
+        del self.data[lower]
+        if lower in self._keys:
+            del self._keys[lower]
     def __iter__(self):
-        return iter(self.data)
+        return iter(self.keys())
     def __contains__(self, key):
-        return self.has_key(key)
+        return key.translate(self._table) in self.data
     def clear(self):
         self.data.clear()
-        self.canon_keys.clear()
+        self._keys.clear()
     def copy(self):
-        if self.__class__ is UserDict:
-            return UserDict(self.data)
-        import copy
-        return copy.copy(self)
+        c = self.__class__(casemapping=self.casemapping)
+        c.data = self.data.copy()
+        c._keys = self._keys.copy()
+        return c
     def keys(self):
-        return self.data.keys()
+        keys = self._keys
+        if not keys:
+            return self.data.keys()
+        return [keys.get(lower, lower) for lower in self.data]
     def items(self):
-        return self.data.items()
+        keys = self._keys
+        return [(keys.get(lower, lower), value)
+                for lower, value in self.data.iteritems()]
     def values(self):
         return self.data.values()
     def has_key(self, key):
-        return irc_lower(key) in self.canon_keys
+        return key in self
     def update(self, dict):
         for k, v in dict.items():
-            self.data[k] = v
+            self[k] = v
     def get(self, key, failobj=None):
-        return self.data.get(key, failobj)
+        return self.data.get(key.translate(self._table), failobj)
 
 
 class Channel:
@@ -314,10 +696,11 @@ class Channel:
     This class can be improved a lot.
     """
 
-    def __init__(self):
-        self.userdict = IRCDict()
-        self.operdict = IRCDict()
-        self.voiceddict = IRCDict()
+    def __init__(self, casemapping="rfc1459"):
+        self.casemapping = casemapping
+        self.userdict = IRCDict(casemapping=casemapping)
+        self.operdict = IRCDict(casemapping=casemapping)
+        self.voiceddict = IRCDict(casemapping=casemapping)
         self.modes = {}
 
     def users(self):
@@ -348,6 +731,18 @@ class Channel:
     def add_user(self, nick):
         self.userdict[nick] = 1
 
+    def clear_users(self):
+        """Forget the users, and so their operator and voice modes."""
+        self.userdict = IRCDict(casemapping=self.casemapping)
+        self.operdict = IRCDict(casemapping=self.casemapping)
+        self.voiceddict = IRCDict(casemapping=self.casemapping)
+
+    def set_casemapping(self, casemapping):
+        """Compare nicks the way a server with this casemapping does."""
+        self.casemapping = casemapping
+        for d in self.userdict, self.operdict, self.voiceddict:
+            d.set_casemapping(casemapping)
+
     def remove_user(self, nick):
         for d in self.userdict, self.operdict, self.voiceddict:
             if nick in d:
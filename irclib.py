@@ -39,8 +39,8 @@ The main features of the IRC client framework are:
   * Messages from an IRC server triggers events, which can be caught
     by event handlers.
   * Reading from and writing to IRC server sockets are normally done
-    by an internal select() loop, but the select()ing may be done by
-    an external main loop.
+    by an internal poll loop (epoll, kqueue, poll or select), but the
+    polling may be done by an external main loop.
   * Functions can be registered to execute at specified times by the
     event-loop.
   * Decodes CTCP tagging correctly (hopefully); I haven't seen any
@@ -48,12 +48,14 @@ The main features of the IRC client framework are:
     specification subtilties.
   * A kind of simple, single-server, object-oriented IRC client class
     that dispatches events to instance methods is included.
+  * Output is buffered and written without blocking, batched per
+    round of event processing.
+  * Connecting doesn't block either; host names are looked up by a
+    small pool of threads, with a cache.
 
 Current limitations:
 
   * The IRC protocol shines through the abstraction a bit too much.
-  * Data is not written asynchronously to the server, i.e. the write()
-    may block if the TCP buffers are stuffed.
   * There are no support for DCC file transfers.
   * The author haven't even read RFC 2810, 2811, 2812 and 2813.
   * Like most projects, documentation is lacking...
@@ -61,15 +63,32 @@ Current limitations:
 .. [IRC specifications] http://www.irchelp.org/irchelp/rfc/
 """
 
+import Queue
 import bisect
+import errno
+import heapq
+import math
+import os
 import re
 import select
 import socket
 import string
 import sys
+import thread
+import threading
 import time
 import types
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
 VERSION = 0, 4, 6
 DEBUG = 0
 
@@ -93,14 +112,452 @@ class IRCError(Exception):
     pass
 
 
-class IRC:
+# Event masks reported by the pollers.
+_READ = 1
+_WRITE = 2
+
+class _Poller:
+    """[Internal] Base class for the I/O multiplexing backends.
+
+    A poller keeps a persistent set of registered file descriptors, so
+    that nothing has to be rebuilt on every pass through the event
+    loop.  The poll method returns a list of (fd, mask) tuples, where
+    mask is a combination of _READ and _WRITE.  Error and hangup
+    conditions are reported as _READ, so that the following recv()
+    notices them.
+    """
+
+    def register(self, fd, write=0):
+        raise IRCError, "Not overridden"
+
+    def modify(self, fd, write=0):
+        raise IRCError, "Not overridden"
+
+    def unregister(self, fd):
+        raise IRCError, "Not overridden"
+
+    def poll(self, timeout=None):
+        raise IRCError, "Not overridden"
+
+
+class _EpollPoller(_Poller):
+    """[Internal] Poller using epoll(7) (Linux)."""
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._in = (select.EPOLLIN | select.EPOLLPRI
+                    | getattr(select, "EPOLLRDHUP", 0))
+
+    def register(self, fd, write=0):
+        self._epoll.register(fd, self._in | (write and select.EPOLLOUT))
+
+    def modify(self, fd, write=0):
+        self._epoll.modify(fd, self._in | (write and select.EPOLLOUT))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        events = []
+        for fd, flags in self._epoll.poll(timeout):
+            mask = 0
+            if flags & ~select.EPOLLOUT:
+                mask = _READ
+            if flags & select.EPOLLOUT:
+                mask = mask | _WRITE
+            events.append((fd, mask))
+        return events
+
+
+class _KqueuePoller(_Poller):
+    """[Internal] Poller using kqueue(2) (BSD, Mac OS X)."""
+
+    def __init__(self):
+        self._kqueue = select.kqueue()
+        self._writers = {}
+
+    def _control(self, fd, filter, flags):
+        self._kqueue.control([select.kevent(fd, filter, flags)], 0)
+
+    def register(self, fd, write=0):
+        self._control(fd, select.KQ_FILTER_READ, select.KQ_EV_ADD)
+        self._writers[fd] = 0
+        self.modify(fd, write)
+
+    def modify(self, fd, write=0):
+        write = write and 1 or 0
+        if self._writers[fd] != write:
+            if write:
+                flags = select.KQ_EV_ADD
+            else:
+                flags = select.KQ_EV_DELETE
+            self._control(fd, select.KQ_FILTER_WRITE, flags)
+            self._writers[fd] = write
+
+    def unregister(self, fd):
+        self.modify(fd, 0)
+        del self._writers[fd]
+        self._control(fd, select.KQ_FILTER_READ, select.KQ_EV_DELETE)
+
+    def poll(self, timeout=None):
+        masks = {}
+        max_events = 2 * len(self._writers) or 1
+        for ev in self._kqueue.control(None, max_events, timeout):
+            if ev.filter == select.KQ_FILTER_WRITE:
+                mask = _WRITE
+            else:
+                mask = _READ
+            if ev.flags & (select.KQ_EV_EOF | select.KQ_EV_ERROR):
+                mask = mask | _READ
+            masks[ev.ident] = masks.get(ev.ident, 0) | mask
+        return masks.items()
+
+
+class _PollPoller(_Poller):
+    """[Internal] Poller using poll(2)."""
+
+    def __init__(self):
+        self._poll = select.poll()
+        self._in = select.POLLIN | select.POLLPRI
+
+    def register(self, fd, write=0):
+        self._poll.register(fd, self._in | (write and select.POLLOUT))
+
+    def modify(self, fd, write=0):
+        self._poll.modify(fd, self._in | (write and select.POLLOUT))
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout * 1000 + 0.999)
+        events = []
+        for fd, flags in self._poll.poll(timeout):
+            mask = 0
+            if flags & ~select.POLLOUT:
+                mask = _READ
+            if flags & select.POLLOUT:
+                mask = mask | _WRITE
+            events.append((fd, mask))
+        return events
+
+
+class _SelectPoller(_Poller):
+    """[Internal] Poller using select(2); the portable fallback."""
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+
+    def register(self, fd, write=0):
+        self._readers[fd] = 1
+        self.modify(fd, write)
+
+    def modify(self, fd, write=0):
+        if write:
+            self._writers[fd] = 1
+        elif fd in self._writers:
+            del self._writers[fd]
+
+    def unregister(self, fd):
+        self.modify(fd, 0)
+        del self._readers[fd]
+
+    def poll(self, timeout=None):
+        if not self._readers:
+            # select() with no descriptors fails on some platforms.
+            time.sleep(timeout is None and 3600 or timeout)
+            return []
+        (i, o, e) = select.select(self._readers.keys(),
+                                  self._writers.keys(), [], timeout)
+        masks = {}
+        for fd in i:
+            masks[fd] = _READ
+        for fd in o:
+            masks[fd] = masks.get(fd, 0) | _WRITE
+        return masks.items()
+
+
+def _make_poller():
+    """[Internal] Return the most scalable poller this platform has."""
+    if hasattr(select, "epoll"):
+        return _EpollPoller()
+    if hasattr(select, "kqueue"):
+        return _KqueuePoller()
+    if hasattr(select, "poll"):
+        return _PollPoller()
+    return _SelectPoller()
+
+
+def _get_monotonic_clock():
+    """[Internal] Return a function that reads a monotonic clock.
+
+    Timers must not jump when the wall clock is adjusted.  Falls back
+    to time.time where no monotonic clock can be found.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    if not sys.platform.startswith("linux"):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1",
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) != 0:
+        return time.time
+
+    def monotonic():
+        # Each call gets its own struct, as any thread may call this.
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+_monotonic = _get_monotonic_clock()
+
+
+class DelayedCommand:
+    """A function call scheduled by IRC.execute_delayed or execute_at.
+
+    Instances are returned by the scheduling methods and can be used
+    to cancel the call before it's executed.
+    """
+    def __init__(self, ircobj, when, function, arguments):
+        self._ircobj = ircobj
+        self.when = when  # On the monotonic clock.
+        self.function = function
+        self.arguments = arguments
+        self._pending = 1
+
+    def cancel(self):
+        """Keep the function from being called.
+
+        Returns 1 if the command was pending, otherwise 0 (it has
+        already been executed or cancelled).
+        """
+        return self._ircobj._cancel_command(self)
+
+    def is_pending(self):
+        """Return true if the command hasn't been executed or cancelled."""
+        return self._pending
+
+
+class _Waker:
+    """[Internal] A pipe that wakes up a thread waiting in poll.
+
+    It sits in the IRC object's fd map like a connection.
+    """
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in self._r, self._w:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._fd = self._r
+
+    def wake(self):
+        try:
+            os.write(self._w, "x")
+        except OSError:
+            # The pipe is full, so the loop will wake up anyway.
+            pass
+
+    def process_data(self):
+        try:
+            os.read(self._r, 4096)
+        except OSError:
+            pass
+
+    def _process_write(self):
+        pass
+
+
+class _SocketWatcher:
+    """[Internal] A socket handled by IRC.watch_socket."""
+    def __init__(self, sock, function):
+        self._sock = sock
+        self._function = function
+        self._fd = None
+
+    def _get_socket(self):
+        return self._sock
+
+    def process_data(self):
+        self._function(self._sock)
+
+    def _process_write(self):
+        pass
+
+
+_ip_address_regexp = re.compile(r"^\d+\.\d+\.\d+\.\d+$")
+
+class _Resolver:
+    """[Internal] Looks up host names in a pool of threads.
+
+    Lookups of a host that is already being looked up wait for that
+    one.  Answers are cached for ttl seconds and failures for
+    negative_ttl seconds; getaddrinfo doesn't tell how long the DNS
+    records are good for.
+    """
+    def __init__(self, irclibobj, threads, ttl, negative_ttl):
+        self.irclibobj = irclibobj
+        self.threads = threads
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._requests = Queue.Queue()
+        self._started = 0      # Threads started.
+        self._idle = 0         # Threads waiting for a request.
+        self._cache = {}       # host -> (expiry time, addresses, error)
+        self._pending = {}     # host -> callbacks waiting for it
+
+    def resolve(self, host, callback):
+        if _ip_address_regexp.match(host):
+            self.irclibobj.execute_delayed(0, callback, ([host], None))
+            return
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(host)
+            if cached is not None and cached[0] > _monotonic():
+                self.irclibobj.execute_delayed(0, callback, cached[1:])
+                return
+            if host in self._pending:
+                self._pending[host].append(callback)
+                return
+            self._pending[host] = [callback]
+            if self._idle == 0 and self._started < self.threads:
+                self._started = self._started + 1
+                t = threading.Thread(target=self._run,
+                                     name="irclib resolver")
+                t.setDaemon(1)
+                t.start()
+        finally:
+            self._lock.release()
+        self._requests.put(host)
+
+    def lookup(self, host):
+        """Look up host right away; returns (addresses, error)."""
+        try:
+            addresses = []
+            for info in socket.getaddrinfo(host, None, socket.AF_INET,
+                                           socket.SOCK_STREAM):
+                if info[4][0] not in addresses:
+                    addresses.append(info[4][0])
+            return addresses, None
+        except socket.error, x:
+            return [], x
+
+    def _run(self):
+        while 1:
+            self._lock.acquire()
+            self._idle = self._idle + 1
+            self._lock.release()
+            host = self._requests.get()
+            self._lock.acquire()
+            self._idle = self._idle - 1
+            self._lock.release()
+            addresses, error = self.lookup(host)
+            if error is None:
+                expiry = _monotonic() + self.ttl
+            else:
+                expiry = _monotonic() + self.negative_ttl
+            self._lock.acquire()
+            try:
+                if len(self._cache) > 256:
+                    now = _monotonic()
+                    for h, entry in self._cache.items():
+                        if entry[0] <= now:
+                            del self._cache[h]
+                self._cache[host] = (expiry, addresses, error)
+                callbacks = self._pending.pop(host)
+            finally:
+                self._lock.release()
+            for callback in callbacks:
+                self.irclibobj.execute_delayed(0, callback,
+                                               (addresses, error))
+
+
+class _HandlerTable:
+    """[Internal] Event handlers in priority order.
+
+    The base of IRC, for the global handlers, and of Connection, for
+    the handlers of one connection.  Sub classes set up two
+    attributes: handlers maps an event type to a sorted list of
+    (priority, handler), with no entry for types without handlers, so
+    the keys are the event types somebody is subscribed to;
+    _dispatch_table maps an event type to a tuple of handler
+    functions to call, in order (see _handlers_for).
+    """
+
+    def _add_handler(self, event, handler, priority):
+        """[Internal]"""
+        if not event in self.handlers:
+            self.handlers[event] = []
+        h = self.handlers[event]
+        h.insert(bisect.bisect_right([p for p, f in h], priority),
+                 (priority, handler))
+        self._dispatch_table.clear()
+
+    def _remove_handler(self, event, handler):
+        """[Internal]"""
+        if not event in self.handlers:
+            return 0
+        self.handlers[event] = [h for h in self.handlers[event]
+                                if handler != h[1]]
+        if not self.handlers[event]:
+            del self.handlers[event]
+        self._dispatch_table.clear()
+        return 1
+
+    def _subscribed(self, eventtype):
+        """[Internal]"""
+        h = self.handlers
+        return eventtype in h or "all_events" in h
+
+    def _handlers_for(self, eventtype):
+        """[Internal] Return the handler functions for an event type.
+
+        The \"all_events\" handlers and those for the type are merged
+        in priority order once and cached until handlers change.
+        """
+        try:
+            return self._dispatch_table[eventtype]
+        except KeyError:
+            pass
+        events = ["all_events"]
+        if eventtype != "all_events":
+            events.append(eventtype)
+        chain = []
+        for n, event in enumerate(events):
+            for i, (priority, handler) in enumerate(self.handlers.get(event, [])):
+                chain.append((priority, n, i, handler))
+        chain.sort()
+        chain = tuple([c[3] for c in chain])
+        self._dispatch_table[eventtype] = chain
+        return chain
+
+
+class IRC(_HandlerTable):
     """Class that handles one or several IRC server connections.
 
     When an IRC object has been instantiated, it can be used to create
     Connection objects that represent the IRC connections.  The
     responsibility of the IRC object is to provide an event-driven
     framework for the connections and to keep the connections alive.
-    It runs a select loop to poll each connection's TCP socket and
+    It runs a poll loop (using epoll, kqueue, poll or select, whichever
+    is best on the platform) over each connection's TCP socket and
     hands over the sockets with incoming data for processing by the
     corresponding connection.
 
@@ -119,8 +576,16 @@ class IRC:
     This will connect to the IRC server irc.some.where on port 6667
     using the nickname my_nickname and send the message \"Hi there!\"
     to the nickname a_nickname.
+
+    Host names are looked up by up to resolver_threads threads, and
+    the answers are cached for dns_ttl seconds (failures for
+    dns_negative_ttl seconds).
     """
 
+    resolver_threads = 4
+    dns_ttl = 300
+    dns_negative_ttl = 30
+
     def __init__(self, fn_to_add_socket=None,
                  fn_to_remove_socket=None,
                  fn_to_add_timeout=None):
@@ -156,8 +621,31 @@ class IRC:
 
         self.fn_to_add_timeout = fn_to_add_timeout
         self.connections = []
-        self.handlers = {}
-        self.delayed_commands = [] # list of tuples in the format (time, function, arguments)
+        self._resolver = None
+        self.poller = _make_poller()
+        self._fd_map = {}  # fd -> connection
+        self.handlers = {}  # See _HandlerTable.
+        self._dispatch_table = {}
+        # Heap of (time, sequence number, DelayedCommand) tuples.
+        self.delayed_commands = []
+        self._command_seq = 0
+        self._cancelled_commands = 0
+        self._timer_lock = threading.Lock()  # Guards the heap.
+        # The thread running process_once, and a _Waker for getting it
+        # out of poll when another thread schedules a command.  The
+        # waker is there from the start: a resolver thread may finish
+        # before the loop first polls.
+        self._loop_thread = None
+        self._waker = None
+        if fcntl is not None:
+            self._waker = _Waker()
+            self.poller.register(self._waker._fd)
+            self._fd_map[self._waker._fd] = self._waker
+        # The thread processing events, if any, and the connections
+        # with output to write when it's done; see Connection._send.
+        self._processing = None
+        self._pending_output = []
+        self._pending_lock = threading.Lock()
 
         self.add_global_handler("ping", _ping_ponger, -42)
 
@@ -177,56 +665,204 @@ class IRC:
 
         See documentation for IRC.__init__.
         """
-        for s in sockets:
-            for c in self.connections:
-                if s == c._get_socket():
+        outer = self._begin_processing()
+        try:
+            for s in sockets:
+                try:
+                    c = self._fd_map.get(s.fileno())
+                except socket.error:
+                    # Closed while processing an earlier socket.
+                    continue
+                if c is not None:
                     c.process_data()
+        finally:
+            if outer:
+                self._end_processing()
 
     def process_timeout(self):
         """Called when a timeout notification is due.
 
         See documentation for IRC.__init__.
         """
-        t = time.time()
-        while self.delayed_commands:
-            if t >= self.delayed_commands[0][0]:
-                self.delayed_commands[0][1](*self.delayed_commands[0][2])
-                del self.delayed_commands[0]
-            else:
-                break
+        outer = self._begin_processing()
+        try:
+            t = _monotonic()
+            heap = self.delayed_commands
+            while 1:
+                self._timer_lock.acquire()
+                try:
+                    if not heap or heap[0][0] > t:
+                        break
+                    command = heapq.heappop(heap)[2]
+                    if not command._pending:
+                        self._cancelled_commands = self._cancelled_commands - 1
+                        continue
+                    command._pending = 0
+                finally:
+                    self._timer_lock.release()
+                command.function(*command.arguments)
+        finally:
+            if outer:
+                self._end_processing()
+
+    def _begin_processing(self):
+        """[Internal] Note that the current thread is processing events.
+
+        Returns true unless it already was.
+        """
+        if self._processing is not None:
+            return 0
+        self._processing = thread.get_ident()
+        return 1
+
+    def _end_processing(self):
+        """[Internal] Write the output buffered while processing events."""
+        self._processing = None
+        self._pending_lock.acquire()
+        try:
+            pending = self._pending_output
+            self._pending_output = []
+        finally:
+            self._pending_lock.release()
+        for c in pending:
+            c._lock.acquire()
+            try:
+                c._flush()
+            finally:
+                c._lock.release()
+
+    def _deferring_output(self):
+        """[Internal] Should output wait for the loop to write it?
+
+        It should while the loop is processing events, so that it's
+        written in one go, and when the loop runs in another thread,
+        which should be the only one touching the sockets.
+        """
+        ident = thread.get_ident()
+        return self._processing == ident \
+               or (self._waker is not None
+                   and self._loop_thread is not None
+                   and self._loop_thread != ident)
+
+    def _flush_later(self, connection):
+        """[Internal] Have the loop write the connection's output."""
+        self._pending_lock.acquire()
+        try:
+            self._pending_output.append(connection)
+        finally:
+            self._pending_lock.release()
+        if self._processing != thread.get_ident():
+            self._waker.wake()
+
+    def watch_socket(self, sock, function):
+        """Call a function whenever a socket has data to read.
+
+        Arguments:
+
+            sock -- A socket (or other object with a fileno method).
+
+            function -- Function to call, with the socket as argument,
+                        in the thread that processes events.
+
+        This lets other input, like a UDP socket, be handled by the
+        event loop instead of in a thread of its own.
+        """
+        self._register_socket(_SocketWatcher(sock, function))
+
+    def unwatch_socket(self, sock):
+        """Stop calling the function given to watch_socket for a socket."""
+        watcher = self._fd_map.get(sock.fileno())
+        if isinstance(watcher, _SocketWatcher):
+            self._unregister_socket(watcher)
+
+    def _cancel_command(self, command):
+        """[Internal] Cancel a DelayedCommand; see its cancel method.
+
+        Cancelled commands stay in the heap until they reach the top,
+        unless they come to make up most of it.
+        """
+        self._timer_lock.acquire()
+        try:
+            if not command._pending:
+                return 0
+            command._pending = 0
+            heap = self.delayed_commands
+            self._cancelled_commands = self._cancelled_commands + 1
+            if self._cancelled_commands > 64 \
+               and self._cancelled_commands * 2 > len(heap):
+                heap[:] = [x for x in heap if x[2]._pending]
+                heapq.heapify(heap)
+                self._cancelled_commands = 0
+        finally:
+            self._timer_lock.release()
+        return 1
+
+    def time_to_next_command(self):
+        """Return the number of seconds until the next delayed command.
+
+        Returns None if no command is scheduled.
+        """
+        self._timer_lock.acquire()
+        try:
+            heap = self.delayed_commands
+            while heap and not heap[0][2]._pending:
+                heapq.heappop(heap)
+                self._cancelled_commands = self._cancelled_commands - 1
+            if not heap:
+                return None
+            when = heap[0][0]
+        finally:
+            self._timer_lock.release()
+        return max(0, when - _monotonic())
 
     def process_once(self, timeout=0):
         """Process data from connections once.
 
         Arguments:
 
-            timeout -- How long the select() call should wait if no
-                       data is available.
+            timeout -- How long the poll should wait if no data is
+                       available, or None to wait until there is.
 
         This method should be called periodically to check and process
         incoming data, if there are any.  If that seems boring, look
         at the process_forever method.
         """
-        sockets = map(lambda x: x._get_socket(), self.connections)
-        sockets = filter(lambda x: x != None, sockets)
-        if sockets:
-            (i, o, e) = select.select(sockets, [], [], timeout)
-            self.process_data(i)
-        else:
-            time.sleep(timeout)
+        self._loop_thread = thread.get_ident()
+        for fd, mask in self.poller.poll(timeout):
+            outer = self._begin_processing()
+            try:
+                c = self._fd_map.get(fd)
+                if c is None:
+                    continue
+                if mask & _WRITE:
+                    c._process_write()
+                    if c._fd != fd:
+                        # The write closed the connection.
+                        continue
+                if mask & _READ:
+                    c.process_data()
+            finally:
+                if outer:
+                    self._end_processing()
         self.process_timeout()
 
-    def process_forever(self, timeout=0.2):
+    def process_forever(self, timeout=None):
         """Run an infinite loop, processing data from connections.
 
-        This method repeatedly calls process_once.
+        This method repeatedly calls process_once, sleeping until
+        either data arrives or the next delayed command is due.
 
         Arguments:
 
-            timeout -- Parameter to pass to process_once.
+            timeout -- The longest time to wait in process_once, or
+                       None (the default) to only wake up for data
+                       and delayed commands.
         """
         while 1:
-            self.process_once(timeout)
+            t = self.time_to_next_command()
+            if t is None or (timeout is not None and t > timeout):
+                t = timeout
+            self.process_once(t)
 
     def disconnect_all(self, message=""):
         """Disconnects all connections."""
@@ -251,13 +887,15 @@ class IRC:
         the Event class.
 
         The handler functions are called in priority order (lowest
-        number is highest priority).  If a handler function returns
-        \"NO MORE\", no more handlers will be called.
-        """
+        number is highest priority), and handlers with the same
+        priority in the order they were added, \"all_events\" handlers
+        first.  If a handler function returns \"NO MORE\", no more
+        handlers will be called.
 
-        if not event in self.handlers:
-            self.handlers[event] = []
-        bisect.insort(self.handlers[event], ((priority, handler)))
+        Global handlers are called before the handlers a connection
+        has of its own; see Connection.add_handler.
+        """
+        self._add_handler(event, handler, priority)
 
     def remove_global_handler(self, event, handler):
         """Removes a global handler function.
@@ -269,13 +907,19 @@ class IRC:
             handler -- Callback function.
 
         Returns 1 on success, otherwise 0.
+
+        A handler may be removed while an event is being dispatched;
+        the handlers of the current event are still called.
         """
-        if not event in self.handlers:
-            return 0
-        for h in self.handlers[event]:
-            if handler == h[1]:
-                self.handlers[event].remove(h)
-        return 1
+        return self._remove_handler(event, handler)
+
+    def is_subscribed(self, eventtype):
+        """Return true if there is a global handler for an event type.
+
+        Handlers for \"all_events\" are subscribed to every type.
+        Connections don't create events nobody is subscribed to.
+        """
+        return self._subscribed(eventtype)
 
     def execute_at(self, at, function, arguments=()):
         """Execute a function at a specified time.
@@ -287,8 +931,10 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a DelayedCommand object.
         """
-        self.execute_delayed(at-time.time(), function, arguments)
+        return self.execute_delayed(at-time.time(), function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
         """Execute a function after a specified time.
@@ -300,10 +946,28 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a DelayedCommand object, whose cancel method keeps the
+        function from being called.
+
+        This method may be called from any thread; the function is
+        called by the thread that processes events.
         """
-        bisect.insort(self.delayed_commands, (delay+time.time(), function, arguments))
+        command = DelayedCommand(self, delay+_monotonic(), function, arguments)
+        self._timer_lock.acquire()
+        try:
+            self._command_seq = self._command_seq + 1
+            heapq.heappush(self.delayed_commands,
+                           (command.when, self._command_seq, command))
+        finally:
+            self._timer_lock.release()
         if self.fn_to_add_timeout:
             self.fn_to_add_timeout(delay)
+        if self._waker is not None \
+           and self._loop_thread != thread.get_ident():
+            # The loop may be waiting in poll for a later deadline.
+            self._waker.wake()
+        return command
 
     def dcc(self, dcctype="chat"):
         """Creates and returns a DCCConnection object.
@@ -319,41 +983,539 @@ class IRC:
         self.connections.append(c)
         return c
 
+    def resolve(self, host, callback):
+        """Look up the IPv4 addresses of a host without blocking.
+
+        Arguments:
+
+            host -- A host name or dotted quad.
+
+            callback -- Function to call, in the thread that processes
+                        events, with a list of addresses and None, or
+                        an empty list and the socket.error explaining
+                        why there are none.
+
+        With an external main loop the lookup is done right away.
+        """
+        if self._resolver is None:
+            self._resolver = _Resolver(self, self.resolver_threads,
+                                       self.dns_ttl, self.dns_negative_ttl)
+        if self.fn_to_add_socket:
+            self.execute_delayed(0, callback, self._resolver.lookup(host))
+        else:
+            self._resolver.resolve(host, callback)
+
+    def race_connect(self, addresses, callback, stagger=.25, timeout=30):
+        """Connect to whichever of several addresses answers first.
+
+        Arguments:
+
+            addresses -- A list of (host, port) tuples, in order of
+                         preference.
+
+            callback -- Function to call with the connected socket and
+                        its index in addresses, or with (None, None)
+                        if no address could be connected to.
+
+            stagger -- Seconds to wait for an attempt before starting
+                       the next one as well.  An attempt that fails
+                       starts the next one right away.
+
+            timeout -- Give up after this many seconds (None means
+                       never).
+
+        Host names are looked up with resolve, and the connects don't
+        block.  They need process_once, since external main loops
+        aren't told when sockets become writable.
+
+        Returns a ServerRace object, whose cancel method stops the
+        race without calling callback.
+        """
+        return ServerRace(self, addresses, callback, stagger, timeout)
+
     def _handle_event(self, connection, event):
-        """[Internal]"""
-        h = self.handlers
-        for handler in h.get("all_events", []) + h.get(event.eventtype(), []):
-            if handler[1](connection, event) == "NO MORE":
-                return
+        """[Internal] Returns \"NO MORE\" if a handler did."""
+        for handler in self._handlers_for(event.eventtype()):
+            if handler(connection, event) == "NO MORE":
+                return "NO MORE"
+
+    def _register_socket(self, connection):
+        """[Internal] Start watching the connection's socket."""
+        sock = connection._get_socket()
+        if self.fn_to_add_socket:
+            self.fn_to_add_socket(sock)
+        fd = sock.fileno()
+        self.poller.register(fd)
+        self._fd_map[fd] = connection
+        connection._fd = fd
+
+    def _set_write_interest(self, connection, write):
+        """[Internal] Ask for (or stop asking for) _process_write calls.
+
+        Only the internal poll loop reports writability; external main
+        loops are never asked to.
+        """
+        if connection._fd is not None:
+            self.poller.modify(connection._fd, write)
 
-    def _remove_connection(self, connection):
-        """[Internal]"""
-        self.connections.remove(connection)
+    def _unregister_socket(self, connection):
+        """[Internal] Stop watching the connection's socket.
+
+        Must be called before the socket is closed.  Calling it for a
+        connection that isn't registered is harmless.
+        """
+        fd = connection._fd
+        if fd is None:
+            return
+        connection._fd = None
+        del self._fd_map[fd]
+        try:
+            self.poller.unregister(fd)
+        except (EnvironmentError, KeyError, ValueError):
+            pass
         if self.fn_to_remove_socket:
             self.fn_to_remove_socket(connection._get_socket())
 
-_rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
+    def _remove_connection(self, connection):
+        """[Internal]"""
+        self.connections.remove(connection)
+        self._unregister_socket(connection)
 
 
-class Connection:
+class Connection(_HandlerTable):
     """Base class for IRC connections.
 
     Must be overridden.
+
+    Output is buffered and never blocks.  What is sent while the IRC
+    object processes events is written when that is done, so that one
+    send call carries all the replies to a message.  Output from other
+    threads is handed over to the thread running process_once, if
+    there is one, so only that thread touches the socket.  What the
+    socket won't take is written when it becomes writable.  While the
+    connection is being made, all output waits.
+
+    get_buffer_size() returns the number of bytes waiting to be
+    written.  When more than high_water bytes are waiting,
+    when_drained() waits until no more than low_water bytes are left.
+    get_stats() tells how the writing has gone.
+
+    Besides the global handlers of the IRC object, a connection may
+    have handlers of its own, which only see its events; see
+    add_handler.
+
+    The connect_timeout attribute is how many seconds a connect waits
+    for the connection (and TLS handshake) to be made before giving
+    up, or None to leave that to the operating system.
     """
+
+    high_water = 2**16
+    low_water = 2**14
+    connect_timeout = 30
+
     def __init__(self, irclibobj):
         self.irclibobj = irclibobj
+        self._fd = None  # Set while registered with the IRC object.
+        self._lock = threading.RLock()  # Guards the output buffer.
+        self._output = []
+        self._output_size = 0
+        self._want_write = 0  # Waiting for the socket to become writable.
+        self._queued = 0      # In the IRC object's _pending_output.
+        self._connecting = 0  # See _start_connect.
+        self._connect_timeout_timer = None
+        self._tls = None  # See _use_tls.
+        self._handshaking = 0
+        self._drain_waiters = []
+        self.handlers = {}  # See _HandlerTable.
+        self._dispatch_table = {}
+        self.reset_stats()
+
+    def add_handler(self, event, handler, priority=0):
+        """Add a handler function for events of this connection.
+
+        Arguments are as for IRC.add_global_handler.  The handler is
+        called after the global handlers for the event, unless one of
+        them returns \"NO MORE\", and only for events of this
+        connection.  The handlers stay when the connection is closed
+        and made again.
+        """
+        self._add_handler(event, handler, priority)
 
-    def _get_socket():
+    def remove_handler(self, event, handler):
+        """Remove a handler function added with add_handler.
+
+        Returns 1 on success, otherwise 0.
+        """
+        return self._remove_handler(event, handler)
+
+    def _handle_event(self, event):
+        """[Internal] Call the global handlers, then our own."""
+        if self.irclibobj._handle_event(self, event) == "NO MORE":
+            return
+        for handler in self._handlers_for(event.eventtype()):
+            if handler(self, event) == "NO MORE":
+                return
+
+    def _get_socket(self):
+        raise IRCError, "Not overridden"
+
+    def _connect_done(self):
+        """[Internal] Called when the connection has been made."""
         raise IRCError, "Not overridden"
 
+    def _connect_failed(self, reason):
+        """[Internal] Called when the connection couldn't be made."""
+        raise IRCError, "Not overridden"
+
+    def _start_connect_timer(self):
+        """[Internal] Give up on the connect after connect_timeout."""
+        if self.connect_timeout is not None:
+            self._connect_timeout_timer = self.execute_delayed(
+                self.connect_timeout, self._connect_timed_out,
+                (self.socket,))
+
+    def _connect_timed_out(self, sock):
+        """[Internal]"""
+        self._connect_timeout_timer = None
+        if sock is self.socket and self._connecting:
+            self._connect_failed("Connection timed out")
+
+    def _stop_connect_timer(self):
+        """[Internal]"""
+        if self._connect_timeout_timer is not None:
+            self._connect_timeout_timer.cancel()
+            self._connect_timeout_timer = None
+
+    def _use_tls(self, tls, server_hostname=None, server_side=0):
+        """[Internal] Set up TLS for the next connection made.
+
+        tls is false for none, an ssl.SSLContext, or true for the
+        default client context.  Returns false if TLS isn't available.
+        """
+        if not tls:
+            self._tls = None
+            return 1
+        if ssl is None or not hasattr(ssl, "SSLContext"):
+            return 0
+        if not isinstance(tls, ssl.SSLContext):
+            tls = ssl.create_default_context()
+        self._tls = (tls, server_hostname, server_side)
+        return 1
+
+    def _wrap_tls(self, sock):
+        """[Internal] Return sock wrapped for TLS, handshake not done."""
+        context, server_hostname, server_side = self._tls
+        return context.wrap_socket(sock, server_side=server_side,
+                                   do_handshake_on_connect=0,
+                                   server_hostname=server_hostname)
+
+    def _handshake(self):
+        """[Internal] Go on with the TLS handshake.
+
+        Returns true when it is done.  Otherwise it waits for the
+        socket, unless it failed and _connect_failed has been called.
+        """
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, x:
+            if x.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._set_want_write(0)
+                return 0
+            if x.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._set_want_write(1)
+                return 0
+            self._connect_failed("TLS handshake failed: %s" % x)
+            return 0
+        except (socket.error, ssl.CertificateError), x:
+            self._connect_failed("TLS handshake failed: %s" % x)
+            return 0
+        self._handshaking = 0
+        return 1
+
+    def get_tls_info(self):
+        """Return None if the connection doesn't use TLS.
+
+        Otherwise returns a dictionary with the keys version (like
+        \"TLSv1.2\") and cipher (the name of the cipher).  The values
+        are None until the handshake is done.
+        """
+        if self._tls is None or self.socket is None:
+            return None
+        if self._connecting:
+            return {"version": None, "cipher": None}
+        return {"version": self.socket.version(),
+                "cipher": self.socket.cipher()[0]}
+
+    def _start_connect(self, host, port, localaddress="", localport=0):
+        """[Internal] Connect a new socket to host and port.
+
+        The host is looked up with IRC.resolve and the connect doesn't
+        block.  Returns true if it is still going on; _connect_done or
+        _connect_failed is then called from the event loop when it's
+        over (and the TLS handshake done, see _use_tls), and output
+        is held until then.  External main loops aren't told when
+        sockets become writable, so with one the connect and the
+        handshake block and false is returned.  Raises socket.error
+        if it fails right away.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((localaddress, localport))
+            if self.irclibobj.fn_to_add_socket:
+                sock.connect((host, port))
+                if self._tls is not None:
+                    sock = self._wrap_tls(sock)
+                    sock.do_handshake()
+        except socket.error:
+            sock.close()
+            raise
+        sock.setblocking(0)
+        self.socket = sock
+        if self.irclibobj.fn_to_add_socket:
+            self.irclibobj._register_socket(self)
+            return 0
+        self._connecting = 1
+        self._set_want_write(1)
+        def resolved(addresses, error):
+            self._resolved(sock, port, addresses, error)
+        self.irclibobj.resolve(host, resolved)
+        return 1
+
+    def _resolved(self, sock, port, addresses, error):
+        """[Internal] The host to connect sock to has been looked up."""
+        if sock is not self.socket or not self._connecting:
+            # Given up on, or replaced by another connection.
+            return
+        if error is not None:
+            self._connect_failed("Couldn't resolve host: %s" % error)
+            return
+        try:
+            err = sock.connect_ex((addresses[0], port))
+        except socket.error, x:
+            self._connect_failed("Couldn't connect to socket: %s" % x)
+            return
+        if err and err not in _in_progress:
+            self._connect_failed(
+                "Couldn't connect to socket: %s" % os.strerror(err))
+            return
+        self.irclibobj._register_socket(self)
+        self.irclibobj._set_write_interest(self, 1)
+
+    def _process_write(self):
+        """[Internal] Called when the socket has become writable."""
+        if self._connecting:
+            if not self._handshaking:
+                err = self.socket.getsockopt(socket.SOL_SOCKET,
+                                             socket.SO_ERROR)
+                if err:
+                    self._connect_failed(
+                        "Couldn't connect to socket: %s" % os.strerror(err))
+                    return
+                if self._tls is not None:
+                    try:
+                        self.socket = self._wrap_tls(self.socket)
+                    except socket.error, x:
+                        self._connect_failed("Couldn't start TLS: %s" % x)
+                        return
+                    self._handshaking = 1
+            # Called when the socket is readable too, while connecting.
+            if self._handshaking and not self._handshake():
+                return
+            self._connecting = 0
+            self._connect_done()
+            if self.socket is None:
+                # Closed by an event handler.
+                return
+        self._lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self._lock.release()
+
+    def get_buffer_size(self):
+        """Return the number of bytes waiting to be written."""
+        return self._output_size
+
+    def get_stats(self):
+        """Return a dictionary of output statistics.
+
+        The keys are:
+
+            lines -- Lines (or DCC messages) sent.
+
+            bytes -- Bytes sent.
+
+            written -- Bytes written to the socket.
+
+            writes -- Calls to the socket's send method.
+
+            partial_writes -- Writes that didn't take all the output.
+
+            blocked_writes -- Writes that didn't take anything.
+
+            buffered -- Bytes waiting to be written.
+
+            dropped -- Bytes thrown away unwritten, because writing
+                       failed or the socket was closed.
+
+            elapsed -- Seconds since the counters were reset.
+
+        The counters cover the time since the connection object was
+        created or reset_stats was called.
+        """
+        return {"lines": self._lines_sent,
+                "bytes": self._bytes_sent,
+                "written": self._bytes_written,
+                "writes": self._writes,
+                "partial_writes": self._partial_writes,
+                "blocked_writes": self._blocked_writes,
+                "buffered": self._output_size,
+                "dropped": self._dropped_bytes,
+                "elapsed": _monotonic() - self._stats_start}
+
+    def reset_stats(self):
+        """Reset the counters returned by get_stats."""
+        self._stats_start = _monotonic()
+        self._lines_sent = 0
+        self._bytes_sent = 0
+        self._bytes_written = 0
+        self._writes = 0
+        self._partial_writes = 0
+        self._blocked_writes = 0
+        self._dropped_bytes = 0
+
+    def when_drained(self, function):
+        """Call a function when the output buffer has drained.
+
+        The function is called right away if no more than high_water
+        bytes are waiting to be written, and otherwise when no more
+        than low_water bytes are left.  It gets one argument: None, or
+        the exception that explains why the connection was closed
+        first.
+        """
+        self._lock.acquire()
+        try:
+            if self._output_size > self.high_water:
+                self._drain_waiters.append(function)
+                return
+        finally:
+            self._lock.release()
+        function(None)
+
+    def _send(self, data):
+        """[Internal] Buffer data for writing to the socket."""
+        self._lock.acquire()
+        try:
+            self._output.append(data)
+            self._output_size = self._output_size + len(data)
+            self._lines_sent = self._lines_sent + 1
+            self._bytes_sent = self._bytes_sent + len(data)
+            if self._want_write or self._queued:
+                return
+            if self.irclibobj._deferring_output():
+                self._queued = 1
+                self.irclibobj._flush_later(self)
+            else:
+                self._flush()
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        """[Internal] Write as much buffered output as the socket takes.
+
+        Everything buffered goes to a single send call.  The caller
+        must hold the lock.
+        """
+        self._queued = 0
+        if self._connecting:
+            return
+        if self._output and self.socket is not None:
+            data = "".join(self._output)
+            self._writes = self._writes + 1
+            try:
+                sent = self.socket.send(data)
+            except socket.error, x:
+                if not _blocked(x):
+                    self._dropped_bytes = self._dropped_bytes + len(data)
+                    self._output = []
+                    self._output_size = 0
+                    self.disconnect("Connection reset by peer.")
+                    return
+                sent = 0
+            self._bytes_written = self._bytes_written + sent
+            if sent == 0:
+                self._blocked_writes = self._blocked_writes + 1
+            elif sent < len(data):
+                self._partial_writes = self._partial_writes + 1
+            if sent < len(data):
+                self._output = [data[sent:]]
+            else:
+                self._output = []
+            self._output_size = len(data) - sent
+        self._set_want_write(self._output_size > 0)
+        if self._drain_waiters and self._output_size <= self.low_water:
+            waiters = self._drain_waiters
+            self._drain_waiters = []
+            for function in waiters:
+                function(None)
+
+    def _set_want_write(self, want):
+        """[Internal]"""
+        if want != self._want_write:
+            self._want_write = want
+            self.irclibobj._set_write_interest(self, want)
+
+    def _close_socket(self, error, flush=1):
+        """[Internal] Close the socket.
+
+        Unless flush is false, or the connection hasn't been made yet,
+        what is left of the output is offered to the socket once,
+        without waiting; what it doesn't take is dropped (and counted
+        in get_stats()).  Pending when_drained() functions get error as
+        argument.
+        """
+        self.irclibobj._unregister_socket(self)
+        self._stop_connect_timer()
+        self._lock.acquire()
+        try:
+            if self._connecting:
+                self._connecting = 0
+                self._handshaking = 0
+                flush = 0
+            left = self._output_size
+            if self._output and flush:
+                # Waiting for a dead link would stall the event loop.
+                self._writes = self._writes + 1
+                try:
+                    sent = self.socket.send("".join(self._output))
+                except socket.error:
+                    sent = 0
+                self._bytes_written = self._bytes_written + sent
+                left = left - sent
+            self._dropped_bytes = self._dropped_bytes + left
+            waiters = self._drain_waiters
+            self._output = []
+            self._output_size = 0
+            self._want_write = 0
+            self._drain_waiters = []
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+        finally:
+            self._lock.release()
+        for function in waiters:
+            function(error)
+
     ##############################
     ### Convenience wrappers.
 
     def execute_at(self, at, function, arguments=()):
-        self.irclibobj.execute_at(at, function, arguments)
+        return self.irclibobj.execute_at(at, function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
-        self.irclibobj.execute_delayed(delay, function, arguments)
+        return self.irclibobj.execute_delayed(delay, function, arguments)
 
 
 class ServerConnectionError(IRCError):
@@ -363,24 +1525,256 @@ class ServerNotConnectedError(ServerConnectionError):
     pass
 
 
-# Huh!?  Crrrrazy EFNet doesn't follow the RFC: their ircd seems to
-# use \n as message separator!  :P
-_linesep_regexp = re.compile("\r?\n")
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+_in_progress = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+def _blocked(x):
+    """[Internal] Is socket.error x just the socket not being ready?"""
+    if ssl is not None and isinstance(x, ssl.SSLError):
+        return x.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                             ssl.SSL_ERROR_WANT_WRITE)
+    return x.args[0] in _would_block
+
+class _ConnectAttempt:
+    """[Internal] A non-blocking TCP connect in a ServerRace."""
+    def __init__(self, race, index, address):
+        self._race = race
+        self._fd = None
+        self.index = index
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        try:
+            err = self.socket.connect_ex(address)
+        except socket.error:
+            self.socket.close()
+            raise
+        if err and err not in _in_progress:
+            self.socket.close()
+            raise socket.error, (err, os.strerror(err))
+
+    def _get_socket(self):
+        return self.socket
+
+    def process_data(self):
+        # A failed connect makes the socket readable too.
+        self._process_write()
+
+    def _process_write(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self._race._attempt_done(self, err)
+
+    def close(self):
+        self._race.irclibobj._unregister_socket(self)
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class ServerRace:
+    """Connection attempts to several addresses; the first one to
+    succeed wins.
+
+    ServerRace objects are created by IRC.race_connect.  The errors
+    attribute holds, for each address, the socket.error its attempt
+    failed with, or None.
+    """
+
+    def __init__(self, irclibobj, addresses, callback, stagger, timeout):
+        self.irclibobj = irclibobj
+        self.addresses = addresses
+        self.callback = callback
+        self.stagger = stagger
+        self.errors = [None] * len(addresses)
+        self._attempts = []
+        self._resolving = 0    # Attempts waiting for IRC.resolve.
+        self._next = 0         # Index of the next address to try.
+        self._done = 0
+        self._stagger_timer = None
+        self._timeout_timer = None
+        if timeout is not None:
+            self._timeout_timer = irclibobj.execute_delayed(
+                timeout, self._finish, (None, None))
+        self._start_next()
+
+    def cancel(self):
+        """Stop the race without calling its callback."""
+        self._finish(None, None, 0)
+
+    def _start_next(self):
+        """[Internal] Start an attempt on the next address."""
+        self._stagger_timer = None
+        if self._done:
+            return
+        if self._next >= len(self.addresses):
+            if not self._attempts and not self._resolving:
+                self._finish(None, None)
+            return
+        index = self._next
+        self._next = index + 1
+        self._resolving = self._resolving + 1
+        def resolved(addresses, error):
+            self._resolved(index, addresses, error)
+        self.irclibobj.resolve(self.addresses[index][0], resolved)
+        if self._next < len(self.addresses):
+            self._stagger_timer = self.irclibobj.execute_delayed(
+                self.stagger, self._start_next)
+
+    def _resolved(self, index, addresses, error):
+        """[Internal]"""
+        self._resolving = self._resolving - 1
+        if self._done:
+            return
+        if error is None:
+            try:
+                attempt = _ConnectAttempt(
+                    self, index, (addresses[0], self.addresses[index][1]))
+            except socket.error, error:
+                pass
+            else:
+                self._attempts.append(attempt)
+                self.irclibobj._register_socket(attempt)
+                self.irclibobj._set_write_interest(attempt, 1)
+                return
+        self._attempt_failed(index, error)
+
+    def _attempt_done(self, attempt, err):
+        """[Internal]"""
+        self._attempts.remove(attempt)
+        if not err:
+            self.irclibobj._unregister_socket(attempt)
+            self._finish(attempt.socket, attempt.index)
+            return
+        attempt.close()
+        self._attempt_failed(attempt.index,
+                             socket.error(err, os.strerror(err)))
+
+    def _attempt_failed(self, index, error):
+        """[Internal] Move on to the next address right away."""
+        self.errors[index] = error
+        if self._stagger_timer is not None:
+            self._stagger_timer.cancel()
+        self._start_next()
+
+    def _finish(self, sock, index, notify=1):
+        """[Internal]"""
+        if self._done:
+            return
+        self._done = 1
+        for timer in self._stagger_timer, self._timeout_timer:
+            if timer is not None:
+                timer.cancel()
+        for attempt in self._attempts:
+            attempt.close()
+        self._attempts = []
+        if notify:
+            self.callback(sock, index)
+
+class _LineBuffer:
+    """[Internal] Splits data read from a socket into lines.
+
+    Data is received straight into a preallocated bytearray, and
+    complete lines are sliced out of it with find(), so a long partial
+    line is neither copied nor rescanned on each read.  The buffer is
+    only compacted when the free space at its end runs low.
+
+    The default read_size is the largest TLS record, so a read from
+    a TLS socket doesn't leave decrypted data behind where poll can't
+    see it.
+    """
+
+    def __init__(self, max_line_length, read_size=2**14):
+        self.max_line_length = max_line_length
+        self.read_size = read_size
+        self.buffer = bytearray(max_line_length + read_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Start of the unfinished line.
+        self.end = 0    # End of the received data.
+        self.scanned = 0  # Data before this has no LF in it.
+
+    def recv(self, sock):
+        """Receive data from sock.
+
+        Returns the number of bytes received; 0 means that the peer
+        has closed the connection.
+        """
+        if len(self.buffer) - self.end < self.read_size:
+            n = self.end - self.start
+            self.buffer[:n] = self.view[self.start:self.end]
+            self.scanned = self.scanned - self.start
+            self.start = 0
+            self.end = n
+        n = sock.recv_into(self.view[self.end:], self.read_size)
+        self.end = self.end + n
+        return n
+
+    def lines(self):
+        """Return the list of complete lines received so far.
+
+        The line terminators (LF or CR LF) are stripped.
+        """
+        # Huh!?  Crrrrazy EFNet doesn't follow the RFC: their ircd seems
+        # to use \n as message separator!  :P
+        buffer = self.buffer
+        view = self.view
+        start = self.start
+        end = self.end
+        lines = []
+        i = buffer.find("\n", self.scanned, end)
+        while i >= 0:
+            j = i
+            if j > start and buffer[j-1] == 13:
+                j = j - 1
+            lines.append(view[start:j].tobytes())
+            start = i + 1
+            i = buffer.find("\n", start, end)
+        if start == end:
+            # Everything consumed; start over at the beginning.
+            start = end = 0
+        self.start = start
+        self.end = end
+        self.scanned = end
+        return lines
+
+    def overflowed(self):
+        """Return true if the unfinished line is too long."""
+        return self.end - self.start > self.max_line_length
+
 
 class ServerConnection(Connection):
     """This class represents an IRC server connection.
 
     ServerConnection objects are instantiated by calling the server
     method on an IRC object.
+
+    The max_line_length attribute is the longest line (in bytes) that
+    the server may send; if it sends a longer one, the connection is
+    closed.  Change it before calling connect.
+
+    set_keepalive() makes the connection PING the server and measure
+    the lag; get_lag() and get_lag_stats() tell what it is.
     """
 
+    max_line_length = 2**14
+    keepalive_interval = None
+    max_lag = 120
+    lag_samples = 100  # How many round trip times to keep.
+
     def __init__(self, irclibobj):
         Connection.__init__(self, irclibobj)
         self.connected = 0  # Not connected yet.
         self.socket = None
+        self.features = ServerFeatures()
+        self._welcomed = 0
+        self._keepalive_timer = None
+        self._ping_token = None  # The PING waiting for a PONG, if any.
+        self._ping_sent = None
+        self._lags = []
+        self._smoothed_lag = None
 
     def connect(self, server, port, nickname, password=None, username=None,
-                ircname=None, localaddress="", localport=0):
+                ircname=None, localaddress="", localport=0, sock=None,
+                tls=None):
         """Connect/reconnect to a server.
 
         Arguments:
@@ -401,15 +1795,83 @@ class ServerConnection(Connection):
 
             localport -- Bind the connection to a specific local port.
 
+            sock -- A socket already connected to the server (for
+                    example by IRC.race_connect) to use instead of
+                    connecting; localaddress and localport are then
+                    ignored.
+
+            tls -- Use TLS: an ssl.SSLContext, or true for one with
+                   the default settings, which verify the server's
+                   certificate against the server name.
+
         This function can be called to reconnect a closed connection.
 
+        The connect doesn't block: the server name is looked up with
+        IRC.resolve, and the registration and other output wait until
+        the connection has been made.  A "connected" event is
+        generated then, or "connect_failed" and "disconnect"
+        events if it can't be made, or hasn't been within
+        connect_timeout seconds; is_connected() is false until then.
+        With an external main loop the connect blocks, as only the
+        internal one notices when it is done.  ServerConnectionError
+        is raised for errors found right away, like not being able to
+        bind to localaddress.
+
         Returns the ServerConnection object.
         """
-        if self.connected:
+        if self.connected or self._connecting:
             self.disconnect("Changing servers")
 
-        self.previous_buffer = ""
-        self.handlers = {}
+        self._prepare_connect(server, port, nickname, password, username,
+                              ircname, localaddress, localport)
+        if not self._use_tls(tls, server):
+            raise ServerConnectionError, "TLS isn't supported."
+        if sock is not None:
+            self.socket = sock
+            self.socket.setblocking(0)
+            self.irclibobj._register_socket(self)
+            connecting = self._tls is not None
+            if connecting:
+                # The handshake is done in _process_write.
+                self._connecting = 1
+                self._set_want_write(1)
+        else:
+            try:
+                connecting = self._start_connect(self.server, self.port,
+                                                 self.localaddress,
+                                                 self.localport)
+            except socket.error, x:
+                self.socket = None
+                raise ServerConnectionError, "Couldn't connect to socket: %s" % x
+        self._log_on()
+        if connecting:
+            self._start_connect_timer()
+        else:
+            self._connect_done()
+        return self
+
+    def _connect_done(self):
+        """[Internal]"""
+        self._stop_connect_timer()
+        self.connected = 1
+        self._handle_event(Event("connected", self.server, "",
+                                 [self.socket.getpeername()[0]]))
+
+    def _connect_failed(self, reason):
+        """[Internal]"""
+        self.connected = 0
+        self._close_socket(ServerConnectionError(reason), 0)
+        self._handle_event(Event("connect_failed", self.server, "", [reason]))
+        self._handle_event(Event("disconnect", self.server, "", [reason]))
+
+    def _prepare_connect(self, server, port, nickname, password, username,
+                         ircname, localaddress, localport):
+        """[Internal] Reset the connection state before connecting."""
+        self._welcomed = 0
+        self._lags = []
+        self._smoothed_lag = None
+        self._lines = _LineBuffer(self.max_line_length)
+        self.features = ServerFeatures()
         self.real_server_name = ""
         self.real_nickname = nickname
         self.server = server
@@ -421,24 +1883,13 @@ class ServerConnection(Connection):
         self.localaddress = localaddress
         self.localport = localport
         self.localhost = socket.gethostname()
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.socket.bind((self.localaddress, self.localport))
-            self.socket.connect((self.server, self.port))
-        except socket.error, x:
-            self.socket.close()
-            self.socket = None
-            raise ServerConnectionError, "Couldn't connect to socket: %s" % x
-        self.connected = 1
-        if self.irclibobj.fn_to_add_socket:
-            self.irclibobj.fn_to_add_socket(self.socket)
 
-        # Log on...
+    def _log_on(self):
+        """[Internal] Register with the server."""
         if self.password:
             self.pass_(self.password)
         self.nick(self.nickname)
         self.user(self.username, self.ircname)
-        return self
 
     def close(self):
         """Close the connection.
@@ -478,22 +1929,29 @@ class ServerConnection(Connection):
     def process_data(self):
         """[Internal]"""
 
+        if self._connecting:
+            # A failed connect may only show up as readable.
+            self._process_write()
+            return
+
         try:
-            new_data = self.socket.recv(2**14)
+            n = self._lines.recv(self.socket)
         except socket.error, x:
+            if _blocked(x):
+                return
             # The server hung up.
             self.disconnect("Connection reset by peer")
             return
-        if not new_data:
+        if not n:
             # Read nothing: connection must be down.
             self.disconnect("Connection reset by peer")
             return
 
-        lines = _linesep_regexp.split(self.previous_buffer + new_data)
-
-        # Save the last, unfinished line.
-        self.previous_buffer = lines[-1]
-        lines = lines[:-1]
+        lines = self._lines.lines()
+        if self._lines.overflowed():
+            # Bad server! Naughty server!
+            self.disconnect("Line too long")
+            return
 
         for line in lines:
             if DEBUG:
@@ -502,32 +1960,26 @@ class ServerConnection(Connection):
             if not line:
                 continue
 
-            prefix = None
-            command = None
-            arguments = None
-            self._handle_event(Event("all_raw_messages",
-                                     self.get_server_name(),
-                                     None,
-                                     [line]))
-
-            m = _rfc_1459_command_regexp.match(line)
-            if m.group("prefix"):
-                prefix = m.group("prefix")
-                if not self.real_server_name:
-                    self.real_server_name = prefix
-
-            if m.group("command"):
-                command = m.group("command").lower()
-
-            if m.group("argument"):
-                a = m.group("argument").split(" :", 1)
-                arguments = a[0].split()
-                if len(a) == 2:
-                    arguments.append(a[1])
-
-            # Translate numerics into more readable strings.
-            if command in numeric_events:
-                command = numeric_events[command]
+            if self._wants("all_raw_messages"):
+                self._handle_event(Event("all_raw_messages",
+                                         self.get_server_name(),
+                                         None,
+                                         [line]))
+
+            tags, prefix, command, rest = _parse_message_head(line)
+            if not command:
+                continue
+            if prefix and not self.real_server_name:
+                self.real_server_name = prefix
+            if command not in _tracked_commands:
+                # Don't bother splitting the arguments of messages that
+                # nobody will see.
+                for eventtype in _derived_events.get(command, (command,)):
+                    if self._wants(eventtype):
+                        break
+                else:
+                    continue
+            arguments = _parse_message_params(rest)
 
             if command == "nick":
                 if nm_to_n(prefix) == self.real_nickname:
@@ -536,16 +1988,28 @@ class ServerConnection(Connection):
                 # Record the nickname in case the client changed nick
                 # in a nicknameinuse callback.
                 self.real_nickname = arguments[0]
+                self._welcomed = 1
+                if self.keepalive_interval:
+                    self.set_keepalive(self.keepalive_interval, self.max_lag)
+            elif command == "pong":
+                if self._ping_token is not None and arguments:
+                    self._pong(arguments[-1])
+            elif command == "featurelist":
+                tokens = arguments[1:]
+                if tokens and " " in tokens[-1]:
+                    # "are supported by this server"
+                    tokens = tokens[:-1]
+                self.features.load(tokens)
 
             if command in ["privmsg", "notice"]:
                 target, message = arguments[0], arguments[1]
                 messages = _ctcp_dequote(message)
 
                 if command == "privmsg":
-                    if is_channel(target):
+                    if self.features.is_channel(target):
                         command = "pubmsg"
                 else:
-                    if is_channel(target):
+                    if self.features.is_channel(target):
                         command = "pubnotice"
                     else:
                         command = "privnotice"
@@ -561,14 +2025,17 @@ class ServerConnection(Connection):
                         if DEBUG:
                             print "command: %s, source: %s, target: %s, arguments: %s" % (
                                 command, prefix, target, m)
-                        self._handle_event(Event(command, prefix, target, m))
-                        if command == "ctcp" and m[0] == "ACTION":
-                            self._handle_event(Event("action", prefix, target, m[1:]))
+                        if self._wants(command):
+                            self._handle_event(Event(command, prefix, target, m, tags))
+                        if command == "ctcp" and m[0] == "ACTION" \
+                               and self._wants("action"):
+                            self._handle_event(Event("action", prefix, target, m[1:], tags))
                     else:
                         if DEBUG:
                             print "command: %s, source: %s, target: %s, arguments: %s" % (
                                 command, prefix, target, [m])
-                        self._handle_event(Event(command, prefix, target, [m]))
+                        if self._wants(command):
+                            self._handle_event(Event(command, prefix, target, [m], tags))
             else:
                 target = None
 
@@ -581,25 +2048,25 @@ class ServerConnection(Connection):
                     arguments = arguments[1:]
 
                 if command == "mode":
-                    if not is_channel(target):
+                    if not self.features.is_channel(target):
                         command = "umode"
 
                 if DEBUG:
                     print "command: %s, source: %s, target: %s, arguments: %s" % (
                         command, prefix, target, arguments)
-                self._handle_event(Event(command, prefix, target, arguments))
+                if self._wants(command):
+                    self._handle_event(Event(command, prefix, target, arguments, tags))
 
-    def _handle_event(self, event):
-        """[Internal]"""
-        self.irclibobj._handle_event(self, event)
-        if event.eventtype() in self.handlers:
-            for fn in self.handlers[event.eventtype()]:
-                fn(self, event)
+    def _wants(self, eventtype):
+        """[Internal] Is anybody subscribed to the event type?"""
+        return self.irclibobj.is_subscribed(eventtype) \
+               or self._subscribed(eventtype)
 
     def is_connected(self):
         """Return connection status.
 
-        Returns true if connected, otherwise false.
+        Returns true if connected, otherwise false; a connection still
+        being made isn't connected yet.
         """
         return self.connected
 
@@ -641,20 +2108,129 @@ class ServerConnection(Connection):
 
             message -- Quit message.
         """
-        if not self.connected:
+        if not self.connected and not self._connecting:
             return
 
         self.connected = 0
+        self._stop_keepalive()
 
         self.quit(message)
 
-        try:
-            self.socket.close()
-        except socket.error, x:
-            pass
-        self.socket = None
+        self._close_socket(ServerNotConnectedError("Not connected."))
         self._handle_event(Event("disconnect", self.server, "", [message]))
 
+    def set_keepalive(self, interval, max_lag=120):
+        """Check that the server is still there.
+
+        Arguments:
+
+            interval -- Seconds between PINGs, or None to send none.
+
+            max_lag -- Seconds to wait for a PONG.
+
+        Once the server has welcomed us, a PING carrying a timestamp
+        is sent every interval seconds, and the time until the
+        matching PONG is recorded as the lag.  If the PONG takes more
+        than max_lag seconds, the connection is taken to be dead and
+        disconnected.
+        """
+        self.keepalive_interval = interval
+        self.max_lag = max_lag
+        self._stop_keepalive()
+        if interval and self.connected and self._welcomed:
+            self._keepalive_timer = self.execute_delayed(
+                interval, self._send_keepalive)
+
+    def _stop_keepalive(self):
+        """[Internal]"""
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+        self._ping_token = None
+
+    def _send_keepalive(self):
+        """[Internal]"""
+        self._keepalive_timer = None
+        if not self.connected:
+            return
+        self._ping_sent = _monotonic()
+        self._ping_token = "LAG%.6f" % self._ping_sent
+        self.ping(self._ping_token)
+        self._keepalive_timer = self.execute_delayed(
+            self.max_lag, self._keepalive_timeout)
+
+    def _keepalive_timeout(self):
+        """[Internal] The PONG is overdue."""
+        self._keepalive_timer = None
+        self.disconnect("Ping timeout: %d seconds"
+                        % (_monotonic() - self._ping_sent))
+
+    def _pong(self, token):
+        """[Internal] Called with the token of each PONG."""
+        if token != self._ping_token:
+            return
+        lag = _monotonic() - self._ping_sent
+        self._ping_token = None
+        self._lags.append(lag)
+        if len(self._lags) > self.lag_samples:
+            del self._lags[0]
+        if self._smoothed_lag is None:
+            self._smoothed_lag = lag
+        else:
+            self._smoothed_lag = self._smoothed_lag \
+                                 + (lag - self._smoothed_lag) / 8
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+        self._keepalive_timer = self.execute_delayed(
+            self.keepalive_interval, self._send_keepalive)
+
+    def get_lag(self):
+        """Return the lag to the server in seconds.
+
+        That is the round trip time of the last keepalive PING, or how
+        long the PONG to the current one has taken, if that is longer.
+        Returns None if there is no measurement.
+        """
+        lag = None
+        if self._lags:
+            lag = self._lags[-1]
+        if self._ping_token is not None:
+            waiting = _monotonic() - self._ping_sent
+            if lag is None or waiting > lag:
+                lag = waiting
+        return lag
+
+    def get_lag_stats(self):
+        """Return a dictionary of lag statistics, in seconds.
+
+        The keys are:
+
+            lag -- As returned by get_lag.
+
+            smoothed -- A moving average of the round trip times.
+
+            median, p90, p99, max -- Percentiles of the last
+                                     lag_samples round trip times.
+
+            samples -- How many round trip times there are.
+
+        Values that can't be known yet are None.
+        """
+        lags = self._lags[:]
+        lags.sort()
+        def percentile(percent):
+            if not lags:
+                return None
+            i = int(math.ceil(len(lags) * percent / 100.0)) - 1
+            return lags[max(i, 0)]
+        return {"lag": self.get_lag(),
+                "smoothed": self._smoothed_lag,
+                "median": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": percentile(100),
+                "samples": len(lags)}
+
     def globops(self, text):
         """Send a GLOBOPS command."""
         self.send_raw("GLOBOPS :" + text)
@@ -680,6 +2256,25 @@ class ServerConnection(Connection):
         """Send a JOIN command."""
         self.send_raw("JOIN %s%s" % (channel, (key and (" " + key))))
 
+    def join_channels(self, channels, keys=None):
+        """Join several channels with as few JOIN commands as possible.
+
+        Arguments:
+
+            channels -- List of channel names.
+
+            keys -- Dictionary from channel names to keys, for the
+                    channels that need one (optional).
+
+        Returns the number of commands sent; see _send_batched.
+        """
+        keys = keys or {}
+        # A JOIN's keys go with its first channels.
+        keyed = [c for c in channels if keys.get(c)]
+        plain = [c for c in channels if not keys.get(c)]
+        return self._send_batched("JOIN", keyed + plain,
+                                  [keys[c] for c in keyed])
+
     def kick(self, channel, nick, comment=""):
         """Send a KICK command."""
         self.send_raw("KICK %s %s%s" % (channel, nick, (comment and (" :" + comment))))
@@ -715,8 +2310,15 @@ class ServerConnection(Connection):
         self.send_raw("MOTD" + (server and (" " + server)))
 
     def names(self, channels=None):
-        """Send a NAMES command."""
-        self.send_raw("NAMES" + (channels and (" " + ",".join(channels)) or ""))
+        """Send a NAMES command.
+
+        A long list of channels is split over as few commands as
+        possible; see _send_batched.
+        """
+        if channels:
+            self._send_batched("NAMES", channels)
+        else:
+            self.send_raw("NAMES")
 
     def nick(self, newnick):
         """Send a NICK command."""
@@ -738,6 +2340,14 @@ class ServerConnection(Connection):
         else:
             self.send_raw("PART " + ",".join(channels) + (message and (" " + message)))
 
+    def part_channels(self, channels, message=""):
+        """Leave several channels with as few PART commands as possible.
+
+        Returns the number of commands sent; see _send_batched.
+        """
+        return self._send_batched("PART", channels,
+                                  trailing=message and (" :" + message))
+
     def pass_(self, password):
         """Send a PASS command."""
         self.send_raw("PASS " + password)
@@ -772,20 +2382,53 @@ class ServerConnection(Connection):
                                           port and (" " + port),
                                           server and (" " + server)))
 
+    def _send_batched(self, command, targets, params=(), trailing=""):
+        """[Internal] Send a command for a list of targets in as few
+        lines as the server takes.
+
+        The lines have no more targets than the server's TARGMAX for
+        the command (RFC 1459 sets no limit for the commands that
+        take lists) and no more than 512 bytes.  The first
+        len(params) targets have a parameter each (like the keys of
+        JOIN), and trailing ends every line.  Returns the number of
+        lines sent.
+        """
+        limit = self.features.max_targets(command, None)
+        room = 510 - len(command) - len(trailing)  # 512 less CR LF.
+        lines = 0
+        i = 0
+        while i < len(targets):
+            n = 0
+            size = 0
+            while i + n < len(targets) and (limit is None or n < limit):
+                # Each target takes a comma (or space) before it, and
+                # so does its parameter.
+                more = len(targets[i + n]) + 1
+                if i + n < len(params):
+                    more = more + len(params[i + n]) + 1
+                if n and size + more > room:
+                    break
+                size = size + more
+                n = n + 1
+            line = "%s %s" % (command, ",".join(targets[i:i + n]))
+            if i < len(params):
+                line = line + " " + ",".join(params[i:i + n])
+            self.send_raw(line + trailing)
+            lines = lines + 1
+            i = i + n
+        return lines
+
     def send_raw(self, string):
         """Send raw string to the server.
 
-        The string will be padded with appropriate CR LF.
+        The string will be padded with appropriate CR LF.  It is
+        buffered; see the Connection class.
         """
         if self.socket is None:
             raise ServerNotConnectedError, "Not connected."
-        try:
-            self.socket.send(string + "\r\n")
-            if DEBUG:
-                print "TO SERVER:", string
-        except socket.error, x:
-            # Ouch!
-            self.disconnect("Connection reset by peer.")
+        self._send(string + "\r\n")
+        if DEBUG:
+            print "TO SERVER:", string
 
     def squit(self, server, comment=""):
         """Send an SQUIT command."""
@@ -845,6 +2488,140 @@ class ServerConnection(Connection):
                                          server and (" " + server)))
 
 
+class ServerFeatures:
+    """What a server supports, as told by its RPL_ISUPPORT messages.
+
+    Every ServerConnection has one as its features attribute.  Until
+    the server says otherwise, the attributes have RFC 1459 values:
+
+        modes -- The most parameter modes a MODE command may have,
+                 or None for no limit.
+
+        targmax -- A dictionary from commands (in upper case) to the
+                   most targets they take, or None for no limit.
+
+        maxtargets -- The most targets of a PRIVMSG or NOTICE, or
+                      None if the server doesn't say.
+
+        prefix -- A list of (mode, symbol) tuples for channel member
+                  statuses, highest first: [(\"o\", \"@\"), (\"v\", \"+\")].
+
+        chanmodes -- A tuple of four strings: list modes, modes that
+                     always take a parameter, modes that take one
+                     when set, and modes that never take one.
+
+        chantypes -- The characters that start channel names.
+
+        nicklen -- The longest nickname.
+
+        casemapping -- \"rfc1459\", \"strict-rfc1459\" or \"ascii\".
+
+        features -- A dictionary of all tokens the server sent, with
+                    their (unescaped) values; tokens without a value
+                    have the value None.
+    """
+
+    def __init__(self):
+        self.modes = 3
+        self.targmax = {}
+        self.maxtargets = None
+        self.prefix = [("o", "@"), ("v", "+")]
+        self.chanmodes = ("b", "k", "l", "imnpst")
+        self.chantypes = "#&+!"
+        self.nicklen = 9
+        self.casemapping = "rfc1459"
+        self.features = {}
+
+    def load(self, tokens):
+        """Take in the tokens of an RPL_ISUPPORT message.
+
+        Malformed values are ignored.
+        """
+        for token in tokens:
+            if token.startswith("-"):
+                name = token[1:].upper()
+                if name in self.features:
+                    del self.features[name]
+                self._set(name, None)
+                continue
+            if "=" in token:
+                name, value = token.split("=", 1)
+                value = _isupport_escape_regexp.sub(
+                    lambda m: chr(int(m.group(1), 16)), value)
+            else:
+                name, value = token, None
+            name = name.upper()
+            self.features[name] = value
+            try:
+                self._set(name, value or "")
+            except ValueError:
+                pass
+
+    def _set(self, name, value):
+        """[Internal] Set the attribute for a token (None resets it)."""
+        if value is None:
+            default = ServerFeatures()
+            attribute = name.lower()
+            if attribute in default.__dict__ and attribute != "features":
+                setattr(self, attribute, getattr(default, attribute))
+        elif name == "MODES":
+            self.modes = value and int(value) or None
+        elif name == "TARGMAX":
+            targmax = {}
+            for item in value.split(","):
+                command, limit = (item.split(":", 1) + [""])[:2]
+                targmax[command.upper()] = limit and int(limit) or None
+            self.targmax = targmax
+        elif name == "MAXTARGETS":
+            self.maxtargets = value and int(value) or None
+        elif name == "PREFIX":
+            if value:
+                modes, symbols = value[1:].split(")", 1)
+                self.prefix = zip(modes, symbols)
+            else:
+                self.prefix = []
+        elif name == "CHANMODES":
+            self.chanmodes = tuple((value.split(",") + ["", "", ""])[:4])
+        elif name == "CHANTYPES":
+            self.chantypes = value
+        elif name == "NICKLEN":
+            self.nicklen = int(value)
+        elif name == "CASEMAPPING":
+            self.casemapping = value.lower()
+
+    def max_targets(self, command, default=1):
+        """Return the most targets a command may have.
+
+        Returns None if there is no limit, and default if the server
+        doesn't say.
+        """
+        command = command.upper()
+        if command in self.targmax:
+            return self.targmax[command]
+        if self.maxtargets and command in ("PRIVMSG", "NOTICE"):
+            return self.maxtargets
+        return default
+
+    def irc_lower(self, s):
+        """Lowercase a string the way the server does."""
+        return irc_lower(s, self.casemapping)
+
+    def is_channel(self, string):
+        """Check if a string is a channel name on the server."""
+        return string and string[0] in self.chantypes
+
+    def parse_channel_modes(self, mode_string):
+        """Parse a channel mode string the way the server does.
+
+        Like the parse_channel_modes function, but knows which modes
+        take arguments from CHANMODES and PREFIX.
+        """
+        list_modes, always, when_set, never = self.chanmodes
+        always = list_modes + always + "".join([m for m, s in self.prefix])
+        return _parse_modes(mode_string, always, when_set)
+
+_isupport_escape_regexp = re.compile(r"\\x([0-9A-Fa-f]{2})")
+
 class DCCConnectionError(IRCError):
     pass
 
@@ -854,7 +2631,13 @@ class DCCConnection(Connection):
 
     DCCConnection objects are instantiated by calling the dcc
     method on an IRC object.
+
+    The max_line_length attribute is the longest line (in bytes) that
+    the peer of a DCC CHAT session may send.
     """
+
+    max_line_length = 2**14
+
     def __init__(self, irclibobj, dcctype):
         Connection.__init__(self, irclibobj)
         self.connected = 0
@@ -863,7 +2646,7 @@ class DCCConnection(Connection):
         self.peeraddress = None
         self.peerport = None
 
-    def connect(self, address, port):
+    def connect(self, address, port, tls=None):
         """Connect/reconnect to a DCC peer.
 
         Arguments:
@@ -871,27 +2654,61 @@ class DCCConnection(Connection):
 
             port -- The port number to connect to.
 
+            tls -- An ssl.SSLContext to use TLS with (optional).  DCC
+                   peers seldom have certificates that can be
+                   verified, so the default context isn't offered.
+
+        As for ServerConnection.connect, the connect doesn't block
+        with the internal event loop.  A "dcc_connect" event is
+        generated when the connection has been made, or
+        "connect_failed" and "dcc_disconnect" events if it can't
+        be, or hasn't been within connect_timeout seconds.  Output
+        waits until then, and the connected attribute is false.
+
         Returns the DCCConnection object.
         """
-        self.peeraddress = socket.gethostbyname(address)
+        self.peeraddress = address
         self.peerport = port
         self.socket = None
-        self.previous_buffer = ""
-        self.handlers = {}
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._lines = _LineBuffer(self.max_line_length)
         self.passive = 0
+        if not self._use_tls(tls, address):
+            raise DCCConnectionError, "TLS isn't supported."
         try:
-            self.socket.connect((self.peeraddress, self.peerport))
+            connecting = self._start_connect(address, port)
         except socket.error, x:
             raise DCCConnectionError, "Couldn't connect to socket: %s" % x
-        self.connected = 1
-        if self.irclibobj.fn_to_add_socket:
-            self.irclibobj.fn_to_add_socket(self.socket)
+        if connecting:
+            self._start_connect_timer()
+        else:
+            self._connect_done()
         return self
 
-    def listen(self):
+    def _connect_done(self):
+        """[Internal]"""
+        self._stop_connect_timer()
+        self.connected = 1
+        self.peeraddress = self.socket.getpeername()[0]
+        self._handle_event(Event("dcc_connect", self.peeraddress, None, None))
+
+    def _connect_failed(self, reason):
+        """[Internal]"""
+        self.connected = 0
+        self._close_socket(DCCConnectionError(reason), 0)
+        self._handle_event(Event("connect_failed", self.peeraddress, "", [reason]))
+        self._handle_event(Event("dcc_disconnect", self.peeraddress, "", [reason]))
+        self.irclibobj._remove_connection(self)
+
+    def listen(self, tls=None):
         """Wait for a connection/reconnection from a DCC peer.
 
+        Arguments:
+
+            tls -- An ssl.SSLContext with a certificate, to use TLS
+                   with as the server side (optional).  The
+                   \"dcc_connect\" event is generated when the
+                   handshake is done.
+
         Returns the DCCConnection object.
 
         The local IP address and port are available as
@@ -899,8 +2716,9 @@ class DCCConnection(Connection):
         peer, the peer address and port are available as
         self.peeraddress and self.peerport.
         """
-        self.previous_buffer = ""
-        self.handlers = {}
+        self._lines = _LineBuffer(self.max_line_length)
+        if not self._use_tls(tls, server_side=1):
+            raise DCCConnectionError, "TLS isn't supported."
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.passive = 1
         try:
@@ -909,6 +2727,7 @@ class DCCConnection(Connection):
             self.socket.listen(10)
         except socket.error, x:
             raise DCCConnectionError, "Couldn't bind socket: %s" % x
+        self.irclibobj._register_socket(self)
         return self
 
     def disconnect(self, message=""):
@@ -918,39 +2737,49 @@ class DCCConnection(Connection):
 
             message -- Quit message.
         """
-        if not self.connected:
+        if not self.connected and not self._connecting:
             return
 
         self.connected = 0
-        try:
-            self.socket.close()
-        except socket.error, x:
-            pass
-        self.socket = None
-        self.irclibobj._handle_event(
-            self,
-            Event("dcc_disconnect", self.peeraddress, "", [message]))
+        self._close_socket(DCCConnectionError("Not connected."))
+        self._handle_event(Event("dcc_disconnect", self.peeraddress, "", [message]))
         self.irclibobj._remove_connection(self)
 
     def process_data(self):
         """[Internal]"""
 
+        if self._connecting:
+            self._process_write()
+            return
+
         if self.passive and not self.connected:
             conn, (self.peeraddress, self.peerport) = self.socket.accept()
+            self.irclibobj._unregister_socket(self)
             self.socket.close()
             self.socket = conn
-            self.connected = 1
+            self.socket.setblocking(0)
+            self.irclibobj._register_socket(self)
             if DEBUG:
                 print "DCC connection from %s:%d" % (
                     self.peeraddress, self.peerport)
-            self.irclibobj._handle_event(
-                self,
-                Event("dcc_connect", self.peeraddress, None, None))
+            if self._tls is not None:
+                # The handshake is done in _process_write, which then
+                # calls _connect_done.
+                self._connecting = 1
+                self._set_want_write(1)
+                self._start_connect_timer()
+                return
+            self._connect_done()
             return
 
         try:
-            new_data = self.socket.recv(2**14)
+            if self.dcctype == "chat":
+                new_data = self._lines.recv(self.socket)
+            else:
+                new_data = self.socket.recv(2**14)
         except socket.error, x:
+            if _blocked(x):
+                return
             # The server hung up.
             self.disconnect("Connection reset by peer")
             return
@@ -962,15 +2791,11 @@ class DCCConnection(Connection):
         if self.dcctype == "chat":
             # The specification says lines are terminated with LF, but
             # it seems safer to handle CR LF terminations too.
-            chunks = _linesep_regexp.split(self.previous_buffer + new_data)
-
-            # Save the last, unfinished line.
-            self.previous_buffer = chunks[-1]
-            if len(self.previous_buffer) > 2**14:
+            chunks = self._lines.lines()
+            if self._lines.overflowed():
                 # Bad peer! Naughty peer!
                 self.disconnect()
                 return
-            chunks = chunks[:-1]
         else:
             chunks = [new_data]
 
@@ -984,9 +2809,7 @@ class DCCConnection(Connection):
             if DEBUG:
                 print "command: %s, source: %s, target: %s, arguments: %s" % (
                     command, prefix, target, arguments)
-            self.irclibobj._handle_event(
-                self,
-                Event(command, prefix, target, arguments))
+            self._handle_event(Event(command, prefix, target, arguments))
 
     def _get_socket(self):
         """[Internal]"""
@@ -996,17 +2819,28 @@ class DCCConnection(Connection):
         """Send data to DCC peer.
 
         The string will be padded with appropriate LF if it's a DCC
-        CHAT session.
+        CHAT session.  It is buffered; see the Connection class.
         """
-        try:
-            self.socket.send(string)
-            if self.dcctype == "chat":
-                self.socket.send("\n")
-            if DEBUG:
-                print "TO PEER: %s\n" % string
-        except socket.error, x:
-            # Ouch!
-            self.disconnect("Connection reset by peer.")
+        if self.socket is None:
+            raise DCCConnectionError, "Not connected."
+        if self.dcctype == "chat":
+            self._send(string + "\n")
+        else:
+            self._send(string)
+        if DEBUG:
+            print "TO PEER: %s\n" % string
+
+_on_method_cache = {}  # class -> names of its on_* methods
+
+def _on_method_names(cls):
+    """[Internal] Return the names of the on_* methods of a class."""
+    try:
+        return _on_method_cache[cls]
+    except KeyError:
+        names = [m for m in dir(cls)
+                 if m.startswith("on_") and callable(getattr(cls, m))]
+        _on_method_cache[cls] = names
+        return names
 
 class SimpleIRCClient:
     """A simple single-server IRC client class.
@@ -1019,7 +2853,16 @@ class SimpleIRCClient:
     (which is done when the server sends a JOIN messsage/command),
     on_privmsg will be called for "privmsg" events, and so on.  The
     handler methods get two arguments: the connection object (same as
-    self.connection) and the event object.
+    self.connection) and the event object.  They are called from an
+    "all_events" handler of the client's connections, with priority
+    -10, so after the global handlers (like the one that answers
+    PINGs), and on_* methods added to the client later work too.
+
+    A sub class whose on_* methods are all there when the client is
+    created, and stay the same, can set the fixed_handlers class
+    attribute to true.  The client then only subscribes to the event
+    types it has methods for, and the other events are not created at
+    all (unless another handler wants them).
 
     Instance attributes that can be used by sub classes:
 
@@ -1028,25 +2871,61 @@ class SimpleIRCClient:
         connection -- The ServerConnection instance.
 
         dcc_connections -- A list of DCCConnection instances.
+
+    The irc_class class attribute is the class of the IRC instance
+    that is created; a sub class may replace it with a compatible
+    class (for example asyncirc.AsyncIRC).
+
+    Several clients can share one IRC instance, and so one event
+    loop, by passing it to the constructor; start() then runs them
+    all.  Each client's handlers are added to its own connections,
+    so it only sees its own events.
     """
-    def __init__(self):
-        self.ircobj = IRC()
+
+    irc_class = IRC
+    fixed_handlers = 0
+
+    def __init__(self, ircobj=None):
+        if ircobj is None:
+            ircobj = self.irc_class()
+        self.ircobj = ircobj
         self.connection = self.ircobj.server()
         self.dcc_connections = []
-        self.ircobj.add_global_handler("all_events", self._dispatcher, -10)
-        self.ircobj.add_global_handler("dcc_disconnect", self._dcc_disconnect, -10)
+        self._on_methods = {}  # event type -> bound on_* method
+        if self.fixed_handlers:
+            for m in _on_method_names(self.__class__):
+                self._on_methods[m[3:]] = getattr(self, m)
+        self._add_handlers(self.connection)
+
+    def _add_handlers(self, connection):
+        """[Internal] Route the events of a connection to the on_* methods."""
+        if self.fixed_handlers and self.__class__._dispatcher.im_func \
+               is SimpleIRCClient._dispatcher.im_func:
+            # Only subscribe to the events we have methods for, so
+            # that the connection can skip the rest.  The priority
+            # keeps on_* methods running before the other handlers
+            # with priority -10, as from the "all_events" handler.
+            for eventtype in self._on_methods.keys():
+                connection.add_handler(eventtype, self._dispatcher, -11)
+        else:
+            # A sub class with its own _dispatcher wants to see everything.
+            connection.add_handler("all_events", self._dispatcher, -10)
 
     def _dispatcher(self, c, e):
         """[Internal]"""
-        m = "on_" + e.eventtype()
-        if hasattr(self, m):
-            getattr(self, m)(c, e)
+        if self.fixed_handlers:
+            method = self._on_methods.get(e.eventtype())
+        else:
+            method = getattr(self, "on_" + e.eventtype(), None)
+        if method is not None:
+            return method(c, e)
 
     def _dcc_disconnect(self, c, e):
         self.dcc_connections.remove(c)
 
     def connect(self, server, port, nickname, password=None, username=None,
-                ircname=None, localaddress="", localport=0):
+                ircname=None, localaddress="", localport=0, sock=None,
+                tls=None):
         """Connect/reconnect to a server.
 
         Arguments:
@@ -1067,13 +2946,17 @@ class SimpleIRCClient:
 
             localport -- Bind the connection to a specific local port.
 
+            sock -- A socket already connected to the server.
+
+            tls -- Use TLS; see ServerConnection.connect.
+
         This function can be called to reconnect a closed connection.
         """
         self.connection.connect(server, port, nickname,
                                 password, username, ircname,
-                                localaddress, localport)
+                                localaddress, localport, sock, tls)
 
-    def dcc_connect(self, address, port, dcctype="chat"):
+    def dcc_connect(self, address, port, dcctype="chat", tls=None):
         """Connect to a DCC peer.
 
         Arguments:
@@ -1082,31 +2965,60 @@ class SimpleIRCClient:
 
             port -- Port to connect to.
 
+            tls -- An ssl.SSLContext to use TLS with (optional).
+
         Returns a DCCConnection instance.
         """
-        dcc = self.ircobj.dcc(dcctype)
-        self.dcc_connections.append(dcc)
-        dcc.connect(address, port)
+        dcc = self._dcc(dcctype)
+        dcc.connect(address, port, tls)
         return dcc
 
-    def dcc_listen(self, dcctype="chat"):
+    def dcc_listen(self, dcctype="chat", tls=None):
         """Listen for connections from a DCC peer.
 
+        Arguments:
+
+            tls -- An ssl.SSLContext with a certificate, to use TLS
+                   with (optional).
+
         Returns a DCCConnection instance.
         """
+        dcc = self._dcc(dcctype)
+        dcc.listen(tls)
+        return dcc
+
+    def _dcc(self, dcctype):
+        """[Internal] Create a DCCConnection with our handlers."""
         dcc = self.ircobj.dcc(dcctype)
+        self._add_handlers(dcc)
+        dcc.add_handler("dcc_disconnect", self._dcc_disconnect, -10)
         self.dcc_connections.append(dcc)
-        dcc.listen()
         return dcc
 
     def start(self):
-        """Start the IRC client."""
+        """Start the IRC client.
+
+        This runs the event loop of the IRC instance, and so every
+        client sharing it.
+        """
         self.ircobj.process_forever()
 
 
-class Event:
-    """Class representing an IRC event."""
-    def __init__(self, eventtype, source, target, arguments=None):
+_unsplit = object()  # Marks an Event whose source hasn't been split.
+
+class Event(object):
+    """Class representing an IRC event.
+
+    Besides the accessor methods, an Event has the nick, user, host
+    and nick_lower properties, the parts of a nickmask source.  They
+    are computed when first asked for; parts missing from the source
+    (for example the user and host of a server) are None.
+    """
+
+    __slots__ = ("_eventtype", "_source", "_target", "_arguments", "_tags",
+                 "_split_source", "_nick", "_user", "_host", "_nick_lower")
+
+    def __init__(self, eventtype, source, target, arguments=None, tags=None):
         """Constructor of Event objects.
 
         Arguments:
@@ -1118,6 +3030,8 @@ class Event:
             target -- The target of the event (a nick or a channel).
 
             arguments -- Any event specific arguments.
+
+            tags -- A dictionary of IRCv3 message tags, or None.
         """
         self._eventtype = eventtype
         self._source = source
@@ -1126,6 +3040,8 @@ class Event:
             self._arguments = arguments
         else:
             self._arguments = []
+        self._tags = tags
+        self._split_source = _unsplit
 
     def eventtype(self):
         """Get the event type."""
@@ -1143,6 +3059,62 @@ class Event:
         """Get the event arguments."""
         return self._arguments
 
+    def tags(self):
+        """Get the IRCv3 message tags (a dictionary), or None."""
+        return self._tags
+
+    def _split(self):
+        """[Internal] Split the source into nick, user and host."""
+        # The source of the split is remembered rather than a flag,
+        # so that the parts follow the source if it is replaced.
+        s = self._source
+        self._split_source = s
+        self._nick_lower = None
+        self._user = None
+        self._host = None
+        if s is None:
+            self._nick = None
+            return
+        i = s.find("!")
+        j = s.find("@", i+1)
+        if j < 0:
+            j = len(s)
+        else:
+            self._host = s[j+1:]
+        if i < 0:
+            self._nick = s[:j]
+        else:
+            self._nick = s[:i]
+            self._user = s[i+1:j]
+
+    def _get_nick(self):
+        if self._split_source is not self._source:
+            self._split()
+        return self._nick
+    nick = property(_get_nick, doc="The nick part of the source.")
+
+    def _get_user(self):
+        if self._split_source is not self._source:
+            self._split()
+        return self._user
+    user = property(_get_user, doc="The user part of the source.")
+
+    def _get_host(self):
+        if self._split_source is not self._source:
+            self._split()
+        return self._host
+    host = property(_get_host, doc="The host part of the source.")
+
+    def _get_nick_lower(self):
+        if self._split_source is not self._source:
+            self._split()
+        if self._nick_lower is None and self._nick is not None:
+            self._nick_lower = irc_lower(self._nick)
+        return self._nick_lower
+    nick_lower = property(_get_nick_lower,
+                          doc="The nick part of the source, lowercased"
+                              " with irc_lower.")
+
 _LOW_LEVEL_QUOTE = "\020"
 _CTCP_LEVEL_QUOTE = "\134"
 _CTCP_DELIMITER = "\001"
@@ -1175,14 +3147,26 @@ _special = "-[]\\`^{}"
 nick_characters = string.ascii_letters + string.digits + _special
 _ircstring_translation = string.maketrans(string.ascii_uppercase + "[]\\^",
                                           string.ascii_lowercase + "{}|~")
+_casemappings = {
+    "rfc1459": _ircstring_translation,
+    "strict-rfc1459": string.maketrans(string.ascii_uppercase + "[]\\",
+                                       string.ascii_lowercase + "{}|"),
+    "ascii": string.maketrans(string.ascii_uppercase,
+                              string.ascii_lowercase),
+}
 
-def irc_lower(s):
+def irc_lower(s, casemapping="rfc1459"):
     """Returns a lowercased string.
 
     The definition of lowercased comes from the IRC specification (RFC
-    1459).
+    1459), unless another casemapping (as given by a server's
+    CASEMAPPING feature) is named.
     """
-    return s.translate(_ircstring_translation)
+    return s.translate(_irc_lower_table(casemapping))
+
+def _irc_lower_table(casemapping):
+    """[Internal] Return the translation table irc_lower uses."""
+    return _casemappings.get(casemapping, _ircstring_translation)
 
 def _ctcp_dequote(message):
     """[Internal] Dequote a message according to CTCP specifications.
@@ -1238,6 +3222,105 @@ def _ctcp_dequote(message):
 
         return messages
 
+def parse_message(line):
+    """Parse a line received from an IRC server.
+
+    Returns a tuple (tags, prefix, command, params).  tags is a
+    dictionary of IRCv3 message tags (or None if there were none),
+    prefix is the message prefix (or None), command is the event type
+    of the command (lowercased, with numerics translated through
+    numeric_events) and params is the list of parameters.
+
+    Example:
+
+    >>> irclib.parse_message("@time=12:00 :nick!u@h PRIVMSG #a :hi there")
+    ({'time': '12:00'}, 'nick!u@h', 'privmsg', ['#a', 'hi there'])
+
+    A line without a command, like an empty one, gives the command
+    "" and no parameters.
+    """
+    tags, prefix, command, rest = _parse_message_head(line)
+    return tags, prefix, command, _parse_message_params(rest)
+
+def _parse_message_head(line):
+    """[Internal] Parse the tags, prefix and command of a line.
+
+    Returns (tags, prefix, command, rest), where rest is the unparsed
+    parameter part of the line.  The parameters are left for
+    _parse_message_params, since splitting them is only needed when
+    somebody cares about the message.
+    """
+    tags = None
+    prefix = None
+    if line[:1] == "@":
+        i = line.find(" ")
+        if i < 0:
+            return None, None, "", ""
+        tags = _parse_tags(line[1:i])
+        line = line[i+1:].lstrip(" ")
+    if not line:
+        # An empty line, or nothing after the tags.
+        return tags, None, "", ""
+    if line[0] == ":":
+        i = line.find(" ")
+        if i < 0:
+            return tags, line[1:], "", ""
+        prefix = line[1:i]
+        if line[i+1:i+2] == " ":
+            line = line[i+1:].lstrip(" ")
+            i = -1
+    else:
+        i = -1
+    j = line.find(" ", i+1)
+    if j < 0:
+        command = line[i+1:]
+        rest = ""
+    else:
+        command = line[i+1:j]
+        rest = line[j:]
+    try:
+        command = _command_events[command]
+    except KeyError:
+        command = _command_event(command)
+    return tags, prefix, command, rest
+
+def _parse_message_params(rest):
+    """[Internal] Split the parameter part of a line."""
+    i = rest.find(" :")
+    if i < 0:
+        return rest.split()
+    params = rest[:i].split()
+    params.append(rest[i+2:])
+    return params
+
+def _command_event(command):
+    """[Internal] Translate a command to an event type, and cache it."""
+    event = intern(numeric_events.get(command, command.lower()))
+    if len(_command_events) < 1024:
+        # Don't let a rogue server fill the cache with junk.
+        _command_events[command] = event
+    return event
+
+_tag_value_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+_tag_value_escape_regexp = re.compile(r"\\(.?)")
+
+def _parse_tags(s):
+    """[Internal] Parse IRCv3 message tags (without the leading @)."""
+    tags = {}
+    for tag in s.split(";"):
+        i = tag.find("=")
+        if i < 0:
+            if tag:
+                tags[tag] = ""
+        else:
+            value = tag[i+1:]
+            if "\\" in value:
+                value = _tag_value_escape_regexp.sub(
+                    lambda m: _tag_value_escapes.get(m.group(1), m.group(1)),
+                    value)
+            tags[tag[:i]] = value
+    return tags
+
 def is_channel(string):
     """Check if a string is a channel name.
 
@@ -1323,8 +3406,12 @@ def parse_channel_modes(mode_string):
 
     return _parse_modes(mode_string, "bklvo")
 
-def _parse_modes(mode_string, unary_modes=""):
-    """[Internal]"""
+def _parse_modes(mode_string, unary_modes="", set_only_modes=""):
+    """[Internal]
+
+    Modes in unary_modes always take an argument, modes in
+    set_only_modes only when they are set.
+    """
     modes = []
     arg_count = 0
 
@@ -1344,7 +3431,7 @@ def _parse_modes(mode_string, unary_modes=""):
             sign = ch
         elif ch == " ":
             collecting_arguments = 1
-        elif ch in unary_modes:
+        elif ch in unary_modes or (sign == "+" and ch in set_only_modes):
             if len(args) >= arg_count + 1:
                 modes.append([sign, ch, args[arg_count]])
                 arg_count = arg_count + 1
@@ -1522,6 +3609,8 @@ numeric_events = {
 
 generated_events = [
     # Generated events
+    "connected",
+    "connect_failed",
     "dcc_connect",
     "dcc_disconnect",
     "dccmsg",
@@ -1548,3 +3637,23 @@ protocol_events = [
 ]
 
 all_events = generated_events + protocol_events + numeric_events.values()
+
+# Commands (as sent by the server) -> event types; see _command_event.
+_command_events = {}
+for _numeric, _event in numeric_events.items():
+    _command_events[_numeric] = intern(_event)
+for _command in ["ERROR", "INVITE", "JOIN", "KICK", "MODE", "NICK", "NOTICE",
+                 "PART", "PING", "PONG", "PRIVMSG", "QUIT", "TOPIC"]:
+    _command_events[_command] = intern(_command.lower())
+
+# Commands whose arguments the connection itself needs, whether or not
+# anybody handles their events.
+_tracked_commands = {"nick": None, "welcome": None, "featurelist": None,
+                     "pong": None}
+
+# Commands that become events of other types.
+_derived_events = {
+    "privmsg": ("privmsg", "pubmsg", "ctcp", "action"),
+    "notice": ("privnotice", "pubnotice", "ctcpreply"),
+    "mode": ("mode", "umode"),
+}
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Benchmark irclib's line parser against the regular expression based
+# parser it replaced.
+#
+
+"""Measure how fast irclib parses lines from an IRC server.
+
+Usage: parse_bench.py [<traffic-file>]
+
+The traffic file holds raw lines as received from a server, one per
+line (for example as printed by irclib with DEBUG on, minus the
+"FROM SERVER: " prefix).  Without it, a built-in sample of typical
+traffic (a NAMES burst, channel chatter, a netsplit) is used.
+"""
+
+import re
+import sys
+import timeit
+
+import irclib
+
+# The sample: what a bot sees when joining a busy channel and sitting
+# through a netsplit.
+sample_traffic = \
+[":irc.example.net 001 wolfbot :Welcome to the Internet Relay Network wolfbot",
+ ":irc.example.net 005 wolfbot MODES=4 CHANTYPES=# PREFIX=(ov)@+ :are supported by this server",
+ ":wolfbot!~wolfbot@host.example.com JOIN #wolf",
+ ":irc.example.net 332 wolfbot #wolf :Werewolf games nightly",
+ ":irc.example.net 353 wolfbot = #wolf :wolfbot @zarf +alice bob carol dave eve mallory trent peggy victor walter",
+ ":irc.example.net 353 wolfbot = #wolf :oscar sybil trudy isaac ivan justin chuck craig dan erin frank grace heidi",
+ ":irc.example.net 366 wolfbot #wolf :End of /NAMES list.",
+ ":alice!~alice@alice.example.org PRIVMSG #wolf :wolfbot: start",
+ ":bob!bob@192.0.2.17 PRIVMSG #wolf :!join",
+ ":carol!~c@carol.example.com PRIVMSG wolfbot :see dave",
+ ":dave!~d@dave.example.com NOTICE #wolf :I'm not the wolf, honest",
+ ":eve!~eve@eve.example.com PRIVMSG #wolf :\001ACTION sniffs the air\001",
+ ":NickServ!NickServ@services. NOTICE wolfbot :This nickname is registered.",
+ ":zarf!~zarf@eblong.com MODE #wolf +v bob",
+ ":mallory!~m@mallory.example.net PART #wolf :brb",
+ ":trent!~t@trent.example.net QUIT :irc.example.net split.example.net",
+ ":peggy!~p@peggy.example.net QUIT :irc.example.net split.example.net",
+ ":victor!~v@victor.example.net QUIT :irc.example.net split.example.net",
+ ":walter!~w@walter.example.net NICK :walter_",
+ "PING :irc.example.net",
+ "@time=2006-01-02T15:04:05.000Z;account=alice :alice!~alice@alice.example.org PRIVMSG #wolf :lynch eve",
+]
+
+_rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
+
+def regexp_parse(line):
+  """The parser irclib used before parse_message."""
+  prefix = None
+  command = None
+  arguments = None
+  m = _rfc_1459_command_regexp.match(line)
+  if m.group("prefix"):
+    prefix = m.group("prefix")
+  if m.group("command"):
+    command = m.group("command").lower()
+  if m.group("argument"):
+    a = m.group("argument").split(" :", 1)
+    arguments = a[0].split()
+    if len(a) == 2:
+      arguments.append(a[1])
+  if command in irclib.numeric_events:
+    command = irclib.numeric_events[command]
+  return prefix, command, arguments
+
+def bench(parse, lines, repeat=7):
+  """Return the number of LINES per second that PARSE handles, in the
+  best of REPEAT runs."""
+  def run():
+    for line in lines:
+      parse(line)
+  number = max(1, 50000 / len(lines))
+  best = min(timeit.repeat(run, number=number, repeat=repeat))
+  return number * len(lines) / best
+
+def main():
+  if len(sys.argv) > 2:
+    print __doc__
+    sys.exit(1)
+  if len(sys.argv) == 2:
+    lines = [l.rstrip("\r\n") for l in open(sys.argv[1])]
+    lines = [l for l in lines if l]
+  else:
+    lines = sample_traffic
+  # The old parser mistakes IRCv3 tags for the command, so it only
+  # gets to compete on plain RFC 1459 lines.
+  plain = [l for l in lines if not l.startswith("@")]
+
+  old = bench(regexp_parse, plain)
+  new = bench(irclib.parse_message, plain)
+  print "%d lines (%d without tags)" % (len(lines), len(plain))
+  print "regexp parser:  %10.0f lines/s" % old
+  print "parse_message:  %10.0f lines/s  (%.2fx)" % (new, new / old)
+  if len(plain) != len(lines):
+    print "with tags:      %10.0f lines/s" % bench(irclib.parse_message, lines)
+
+if __name__ == "__main__":
+  main()
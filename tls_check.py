@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# Check irclib's TLS support against a local TLS server.
+#
+
+"""Connect to a TLS server on localhost with irclib and check the result.
+
+Usage: tls_check.py <cert-file> <key-file>
+
+The certificate must be for the name localhost; a self-signed one will
+do, for example made with
+
+  openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=localhost \\
+      -keyout key.pem -out cert.pem
+
+A thread plays IRC server behind TLS.  The checks are:
+
+  - a server connection verifying the certificate gets "connected",
+    then "welcome", and output queued before the handshake arrives;
+  - get_tls_info() reports the TLS version and cipher;
+  - connecting by IP address (not matching the certificate) fails with
+    "connect_failed";
+  - a DCC CHAT over TLS gets through both ways.
+
+Prints what failed and exits with status 1 if anything did.
+"""
+
+import socket
+import ssl
+import sys
+import threading
+import time
+
+import irclib
+
+def serve(listener, context, received):
+  """Accept connections on LISTENER and answer them like an IRC server
+  with TLS, appending the lines received to RECEIVED."""
+  while 1:
+    conn, addr = listener.accept()
+    t = threading.Thread(target=serve_one, args=(conn, context, received))
+    t.setDaemon(1)
+    t.start()
+
+def serve_one(conn, context, received):
+  try:
+    conn = context.wrap_socket(conn, server_side=1)
+  except (ssl.SSLError, socket.error):
+    return
+  buf = ""
+  while 1:
+    try:
+      data = conn.recv(4096)
+    except (ssl.SSLError, socket.error):
+      return
+    if not data:
+      return
+    buf = buf + data
+    while "\r\n" in buf:
+      line, buf = buf.split("\r\n", 1)
+      received.append(line)
+      if line.startswith("USER "):
+        conn.sendall(":localhost 001 tlscheck :Welcome\r\n")
+
+def run(ircobj, seconds, done):
+  """Run IRCOBJ's event loop until DONE() is true or SECONDS pass."""
+  end = time.time() + seconds
+  while time.time() < end and not done():
+    ircobj.process_once(0.05)
+
+def main():
+  if len(sys.argv) != 3:
+    print __doc__
+    sys.exit(1)
+  certfile, keyfile = sys.argv[1:]
+  if ssl is None or not hasattr(ssl, "SSLContext"):
+    print "Error: The ssl module has no SSLContext."
+    sys.exit(1)
+  server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+  server_context.load_cert_chain(certfile, keyfile)
+  client_context = ssl.create_default_context(cafile=certfile)
+
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(5)
+  port = listener.getsockname()[1]
+  received = []
+  t = threading.Thread(target=serve,
+                       args=(listener, server_context, received))
+  t.setDaemon(1)
+  t.start()
+
+  failures = []
+  ircobj = irclib.IRC()
+  events = []
+  for eventtype in ["connected", "welcome", "connect_failed"]:
+    ircobj.add_global_handler(
+      eventtype, lambda c, e: events.append(e.eventtype()))
+
+  c = ircobj.server()
+  c.connect("localhost", port, "tlscheck", tls=client_context)
+  c.privmsg("#tls", "queued before the handshake")
+  run(ircobj, 5, lambda: "welcome" in events or "connect_failed" in events)
+  if events != ["connected", "welcome"]:
+    failures.append("verified connect: got events %s" % events)
+  info = c.get_tls_info()
+  if not info or not info["version"] or not info["cipher"]:
+    failures.append("get_tls_info() gave %r" % (info,))
+  else:
+    print "TLS version %s, cipher %s" % (info["version"], info["cipher"])
+  run(ircobj, 2, lambda: "PRIVMSG #tls :queued before the handshake"
+                         in received)
+  if "PRIVMSG #tls :queued before the handshake" not in received:
+    failures.append("output queued while connecting never arrived")
+  c.disconnect("done")
+
+  del events[:]
+  c.connect("127.0.0.1", port, "tlscheck", tls=client_context)
+  run(ircobj, 5, lambda: events)
+  if events != ["connect_failed"]:
+    failures.append("name mismatch: got events %s" % events)
+
+  dcc_context = ssl.create_default_context(cafile=certfile)
+  dcc_context.check_hostname = False
+  listening = ircobj.dcc("chat")
+  listening.listen(server_context)
+  connecting = ircobj.dcc("chat")
+  messages = []
+  for d in [listening, connecting]:
+    d.add_handler("dccmsg",
+                  lambda c, e: messages.append((c, e.arguments()[0])))
+  connecting.connect("127.0.0.1", listening.localport, dcc_context)
+  connecting.privmsg("ping")
+  run(ircobj, 5, lambda: messages)
+  if messages == [(listening, "ping")]:
+    listening.privmsg("pong")
+    run(ircobj, 5, lambda: len(messages) > 1)
+  if messages != [(listening, "ping"), (connecting, "pong")]:
+    failures.append("DCC CHAT: got %s" % [m for c, m in messages])
+  for d in [listening, connecting]:
+    d.disconnect()
+
+  for failure in failures:
+    print "FAILED:", failure
+  if failures:
+    sys.exit(1)
+  print "All TLS checks passed."
+
+if __name__ == "__main__":
+  main()
@@ -120,21 +120,27 @@ IRC_BOLD = "\x02"
 
 class WolfBot(SingleServerIRCBot):
   GAMESTATE_NONE, GAMESTATE_STARTING, GAMESTATE_RUNNING  = range(3)
+  fixed_handlers = 1
   def __init__(self, channel, nickname, nickpass, server, port=defaultPort,
-      debug=False):
-    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname)
+      debug=False, ircobj=None):
+    SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname,
+                                ircobj=ircobj)
     self.channel = channel
+    self.join_channels([channel])
     # self.nickname is the nickname we _want_. The nickname we actually
     # have at any particular time is c.get_nickname().
     self.nickname = nickname
     self.nickpass = nickpass
     self.debug = debug
+    if debug:
+      self.connection.add_handler("all_events", self._print_event, -20)
     self.moderation = True
     self._reset_gamedata()
-    self.queue = OutputManager(self.connection)
-    self.queue.start()
+    self.queue = OutputManager(self.connection, coalesce=True)
+
+  def start(self):
     try:
-      self.start()
+      SingleServerIRCBot.start(self)
     except KeyboardInterrupt:
       self.connection.quit("Ctrl-C at console")
       print "Quit IRC."
@@ -163,18 +169,11 @@ class WolfBot(SingleServerIRCBot):
     'topicinfo': None,
     'ping': None,
     }
-  def _dispatcher(self, c, e):
-    if self.debug:
-      eventtype = e.eventtype()
-      if eventtype not in self._uninteresting_events:
-        source = e.source()
-        if source is not None:
-          source = nm_to_n(source)
-        else:
-          source = ''
-        print "E: %s (%s->%s) %s" % (eventtype, source, e.target(),
-            e.arguments())
-    SingleServerIRCBot._dispatcher(self, c, e)
+  def _print_event(self, c, e):
+    eventtype = e.eventtype()
+    if eventtype not in self._uninteresting_events:
+      print "E: %s (%s->%s) %s" % (eventtype, e.nick or '', e.target(),
+          e.arguments())
 
   def on_nicknameinuse(self, c, e):
     c.nick(c.get_nickname() + "_")
@@ -238,7 +237,7 @@ class WolfBot(SingleServerIRCBot):
 
 
   def on_join(self, c, e):
-    nick = nm_to_n(e.source())
+    nick = e.nick
     if nick == c.get_nickname():
       chan = e.target()
       self.connection.mode(self.channel, '')
@@ -258,18 +257,17 @@ class WolfBot(SingleServerIRCBot):
       
 
   def on_quit(self, c, e):
-    source = nm_to_n(e.source())
+    source = e.nick
     self._removeUser(source)
     if source == self.nickname:
       # Our desired nick just quit - take the nick back
       c.nick(self.nickname)
 
   def on_nick(self, c, e):
-    self._renameUser(nm_to_n(e.source()), e.target())
+    self._renameUser(e.nick, e.target())
 
 
   def on_welcome(self, c, e):
-    c.join(self.channel)
     if c.get_nickname() != self.nickname:
       # Reclaim our desired nickname
       c.privmsg('nickserv', 'ghost %s %s' % (self.nickname, self.nickpass))
@@ -299,7 +297,7 @@ class WolfBot(SingleServerIRCBot):
 
 
   def multimode(self, mode, nicks):
-    max_batch = 4 # FIXME: Get this from features message
+    max_batch = self.connection.features.modes or len(nicks)
     assert len(mode) == 2
     assert mode[0] in ('-', '+')
     while nicks:
@@ -314,12 +312,12 @@ class WolfBot(SingleServerIRCBot):
 
 
   def on_privnotice(self, c, e):
-    source = e.source()
-    if source and irc_lower(nm_to_n(source)) == 'nickserv':
+    if e.nick_lower == 'nickserv':
       if e.arguments()[0].find('IDENTIFY') >= 0:
         # Received request to identify
         if self.nickpass and self.nickname == c.get_nickname():
-          self.queue.send('identify %s' % self.nickpass, 'nickserv')
+          self.queue.send('identify %s' % self.nickpass, 'nickserv',
+              OutputManager.CONTROL)
 
 
   GAME_STARTER_TIMEOUT_MINS = 4
@@ -327,7 +325,7 @@ class WolfBot(SingleServerIRCBot):
     "Implement a timeout for game controller."
     if self.game_starter is None:
       return
-    nick = nm_to_n(e.source())
+    nick = e.nick
     if self.game_starter == nick:
       self.game_starter_last_seen = time.time()
     else:
@@ -344,7 +342,7 @@ class WolfBot(SingleServerIRCBot):
 
 
   def on_part(self, c, e):
-    self._removeUser(nm_to_n(e.source()))
+    self._removeUser(e.nick)
 
   def on_kick(self, c, e):
     self._removeUser(nm_to_n(e.arguments()[0]))
@@ -392,9 +390,9 @@ class WolfBot(SingleServerIRCBot):
   def reply(self, e, text):
     "Send TEXT to public channel or as private msg, in reply to event E."
     if e.eventtype() == "pubmsg":
-      self.say_public("%s: %s" % (nm_to_n(e.source()), text))
+      self.say_public("%s: %s" % (e.nick, text))
     else:
-      self.say_private(nm_to_n(e.source()), text)
+      self.say_private(e.nick, text)
 
 
   def start_game(self, game_starter):
@@ -611,7 +609,7 @@ class WolfBot(SingleServerIRCBot):
     if self.time != "night":
       self.reply(e, "Are you a seer?  In any case, it's not nighttime.")
     else:
-      if nm_to_n(e.source()) != self.seer:
+      if e.nick != self.seer:
         self.reply(e, "Huh?")
       else:
         if who not in self.live_players:
@@ -634,7 +632,7 @@ class WolfBot(SingleServerIRCBot):
     if self.time != "night":
       self.reply(e, "Are you a werewolf?  In any case, it's not nighttime.")
       return
-    if nm_to_n(e.source()) not in self.wolves:
+    if e.nick not in self.wolves:
       self.reply(e, "Huh?")
       return
     if who not in self.live_players:
@@ -642,7 +640,7 @@ class WolfBot(SingleServerIRCBot):
       return
     if len(self.wolves) > 1:
       # Multiple wolves are alive:
-      self.wolf_votes[nm_to_n(e.source())] = who
+      self.wolf_votes[e.nick] = who
       self.reply(e, "Your vote is acknowledged.")
 
       # If all wolves have voted, look for agreement:
@@ -757,7 +755,7 @@ class WolfBot(SingleServerIRCBot):
   def lynch_vote(self, e, lynchee):
     "Register a vote to lynch LYNCHEE."
 
-    lyncher = nm_to_n(e.source())
+    lyncher = e.nick
     # sanity checks
     if self.time != "day":
       self.reply(e, "Sorry, lynching only happens during the day.")
@@ -803,11 +801,11 @@ class WolfBot(SingleServerIRCBot):
     self.cmd_stats(args, e)
 
   def cmd_start(self, args, e):
-    target = nm_to_n(e.source())
+    target = e.nick
     self.start_game(target)
 
   def cmd_end(self, args, e):
-    target = nm_to_n(e.source())
+    target = e.nick
     self.end_game(target)
 
   def cmd_votes(self, args, e):
@@ -844,7 +842,7 @@ class WolfBot(SingleServerIRCBot):
       self.connection.nick(args[0])
 
   def cmd_see(self, args, e):
-    target = nm_to_n(e.source())
+    target = e.nick
     if len(args) == 1:
       viewee = self.match_name(args[0].strip())
       if viewee is not None:
@@ -853,7 +851,7 @@ class WolfBot(SingleServerIRCBot):
     self.reply(e, "See whom?")
 
   def cmd_kill(self, args, e):
-    target = nm_to_n(e.source())
+    target = e.nick
     if len(args) == 1:
       killee = self.match_name(args[0].strip())
       if killee is not None:
@@ -862,7 +860,7 @@ class WolfBot(SingleServerIRCBot):
     self.reply(e, "Kill whom?")
 
   def cmd_lynch(self, args, e):
-    target = nm_to_n(e.source())
+    target = e.nick
     if len(args) == 1:
       lynchee = self.match_name(args[0])
       if lynchee is not None:
@@ -877,7 +875,7 @@ class WolfBot(SingleServerIRCBot):
     if self.gamestate == self.GAMESTATE_RUNNING:
       self.reply(e, 'Game is in progress; please wait for the next game.')
       return
-    player = nm_to_n(e.source())
+    player = e.nick
     if player in self.live_players:
       self.reply(e, 'You were already in the game!')
     else:
@@ -891,7 +889,7 @@ class WolfBot(SingleServerIRCBot):
     self.reply(e, "My source code is available at %s" % svn_url)
 
   def cmd_moderation(self, args, e):
-    if self.game_starter and self.game_starter != nm_to_n(e.source()):
+    if self.game_starter and self.game_starter != e.nick:
       self.reply(e, "%s started the game, and so has administrative control. "
           "Request denied." % self.game_starter)
       return
@@ -906,7 +904,7 @@ class WolfBot(SingleServerIRCBot):
       self.reply(e, "Usage: moderation on|off")
       return
     self.say_public('Moderation turned %s by %s'
-        % (args[0], nm_to_n(e.source())))
+        % (args[0], e.nick))
     self.fix_modes()
 
   def do_command(self, e, cmd):
@@ -924,7 +922,7 @@ class WolfBot(SingleServerIRCBot):
         cmds = cmds[1:]
 
     # Dead players should not speak.
-    if nm_to_n(e.source()) in self.dead_players:
+    if e.nick in self.dead_players:
       if (cmd != "stats") and (cmd != "status") and (cmd != "help"):
         self.reply(e, "Please -- dead players should keep quiet.")
         return 0
@@ -978,11 +976,16 @@ def main():
   import ConfigParser
   c = ConfigParser.ConfigParser()
   c.read(configfile)
-  cfgsect = 'wolfbot'
+  bot_from_config(c, 'wolfbot', debug=debug).start()
+
+
+def bot_from_config(c, cfgsect, ircobj=None, debug=False):
   host = c.get(cfgsect, 'host')
   channel = c.get(cfgsect, 'channel')
   nickname = c.get(cfgsect, 'nickname')
   nickpass = c.get(cfgsect, 'nickpass')
+  if c.has_option(cfgsect, 'debug'):
+    debug = debug or c.getboolean(cfgsect, 'debug')
 
   s = string.split(host, ":", 1)
   server = s[0]
@@ -995,7 +998,7 @@ def main():
   else:
     port = defaultPort
 
-  bot = WolfBot(channel, nickname, nickpass, server, port, debug)
+  return WolfBot(channel, nickname, nickpass, server, port, debug, ircobj)
 
 
 if __name__ == "__main__":